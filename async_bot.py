@@ -0,0 +1,573 @@
+import asyncio
+import contextvars
+import datetime
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from telebot import asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+from telebot.types import ReplyKeyboardMarkup, ReplyKeyboardRemove
+
+from bot import MARKUP, START_TEXT, INFO_TEXT, FORM_TEXT, DEADLINE_BUTTONS, MORE_DATES, \
+    MAX_UPLOAD_SIZE, pack_messages, parse_date, parse_time, parse_timezone, format_notification_settings, \
+    get_dates_markup, get_delete_markup, get_find_page, get_all_page, pending_uploads, conversations, \
+    notification_scheduler
+from imports import ImportQueue
+from metrics import registry, instrument_bot, instrument_handler, start_server
+from my_token import TOKEN
+from planning import TIMEZONE, get_schedule, get_schedule_range, in_schedule, get_subjects, get_next_lesson_date, \
+    get_next_lessons, format_date, add_homework, get_homework, delete_homework, delete_past_homework, \
+    get_notification_settings, set_notification_settings
+from scheduler import TICK
+from state import ADD_SUBJECT, ADD_DATE, ADD_TYPE, ADD_DESCRIPTION, DELETE_DATE, CONFIRM_SCHEDULE
+from transfer import EXPORT_FORMATS, import_homework, spool_export
+
+DB_WORKERS = 4
+NOTIFICATION_WORKERS = 1
+CLEANUP_INTERVAL = 24 * 60 * 60
+EVICTION_INTERVAL = 60 * 60
+UPLOAD_EVICTION_INTERVAL = 60
+
+logger = logging.getLogger('async_bot')
+
+if os.environ.get('BOT_API_URL'):
+    asyncio_helper.API_URL = os.environ['BOT_API_URL'].rstrip('/') + '/bot{0}/{1}'
+    asyncio_helper.FILE_URL = os.environ['BOT_API_URL'].rstrip('/') + '/file/bot{0}/{1}'
+
+
+class OrderedAsyncTeleBot(AsyncTeleBot):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.chat_locks = {}
+        self.chat_waiters = {}
+
+    async def process_new_updates(self, updates):
+        chats = {}
+        for update in updates:
+            chats.setdefault(get_update_key(update), []).append(update)
+
+        await asyncio.gather(*(self.process_chat_updates(key, chat_updates) for key, chat_updates in chats.items()))
+
+    async def process_chat_updates(self, key, updates):
+        lock = self.chat_locks.setdefault(key, asyncio.Lock())
+        self.chat_waiters[key] = self.chat_waiters.get(key, 0) + 1
+        try:
+            async with lock:
+                for update in updates:
+                    await super().process_new_updates([update])
+        finally:
+            self.chat_waiters[key] -= 1
+            if not self.chat_waiters[key]:
+                del self.chat_waiters[key]
+                del self.chat_locks[key]
+
+
+def get_update_key(update):
+    for event in (update.message, update.edited_message, update.callback_query):
+        if event is not None and event.from_user is not None:
+            return event.from_user.id
+
+    return update.update_id
+
+
+bot = OrderedAsyncTeleBot(TOKEN)
+db_executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix='DatabaseThread')
+notification_executor = ThreadPoolExecutor(max_workers=NOTIFICATION_WORKERS, thread_name_prefix='NotificationThread')
+import_queue = None
+
+
+async def run_in(executor, function, *args, **kwargs):
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(executor, partial(context.run, function, *args, **kwargs))
+
+
+async def run(function, *args, **kwargs):
+    return await run_in(db_executor, function, *args, **kwargs)
+
+
+def today():
+    return datetime.datetime.now(TIMEZONE).date().toordinal()
+
+
+async def check_cancel(message, adding=True):
+    if message.text.lower() in ('cancel', '❌ cancel ❌'):
+        await run(conversations.finish, message.from_user.id)
+        await bot.send_message(message.chat.id, 'Homework {} was cancelled.'.format('adding' if adding else 'deleting'),
+                               reply_markup=MARKUP)
+        return True
+
+    return False
+
+
+async def process_date(message, retry=False):
+    try:
+        date = parse_date(message.text)
+        if date < today():
+            await bot.send_message(message.chat.id, 'Error: Past date.\n'
+                                                    'Please enter a future or present date.')
+        else:
+            return date
+
+    except Exception as e:
+        if retry:
+            await bot.send_message(message.chat.id, 'Error: Incorrect date ({}).\n'
+                                                    'Make sure to type it in <b>DD.⁠MM</b> format.'.format(str(e)),
+                                   parse_mode='HTML')
+        return False
+
+
+async def send_schedules(chat_id, schedules):
+    for text in pack_messages(schedules):
+        await bot.send_message(chat_id, text, parse_mode='HTML')
+
+
+async def in_conversation(message):
+    return await run(conversations.get, message.from_user.id) is not None
+
+
+@bot.message_handler(func=in_conversation,
+                     content_types=['text', 'document', 'photo', 'audio', 'video', 'voice', 'sticker'])
+async def handle_conversation(message):
+    handler = STEP_HANDLERS.get(await run(conversations.get, message.from_user.id))
+    if handler:
+        await handler(message)
+    else:
+        await run(conversations.finish, message.from_user.id)
+
+
+@bot.message_handler(commands=['start'])
+@bot.message_handler(func=lambda message: message.text is not None and message.text.lower() == 'start')
+async def start(message):
+    await bot.send_message(message.chat.id, START_TEXT, reply_markup=MARKUP, parse_mode='HTML')
+
+
+@bot.message_handler(commands=['info', 'help'])
+@bot.message_handler(func=lambda message: message.text is not None and message.text.lower() in ('info', 'help'))
+async def info(message):
+    await bot.send_message(message.chat.id, INFO_TEXT, reply_markup=MARKUP, parse_mode='HTML')
+
+
+@bot.message_handler(commands=['form'])
+@bot.message_handler(func=lambda message: message.text is not None and message.text.lower() == 'form')
+async def form(message):
+    await bot.send_message(message.chat.id, FORM_TEXT, reply_markup=MARKUP, parse_mode='HTML')
+
+    with open('files/form.xlsx', mode='rb') as form_file:
+        await bot.send_document(message.chat.id, form_file)
+
+
+@bot.message_handler(commands=['notify', 'timezone'])
+async def notification_settings(message):
+    command, *args = message.text.split()
+    try:
+        if args and command.startswith('/notify'):
+            await run(set_notification_settings, message.from_user.id, notification_time=parse_time(args[0]))
+        elif args:
+            await run(set_notification_settings, message.from_user.id, timezone=parse_timezone(args[0]))
+
+        settings = await run(get_notification_settings, message.from_user.id)
+        await bot.send_message(message.chat.id, format_notification_settings(*settings), reply_markup=MARKUP,
+                               parse_mode='HTML')
+
+    except Exception as e:
+        await bot.send_message(message.chat.id, 'Error: {}.'.format(str(e)), reply_markup=MARKUP)
+
+
+@bot.message_handler(commands=['find'])
+async def find(message):
+    try:
+        text, markup = await run(get_find_page, message.from_user.id, message.text.partition(' ')[2])
+        await bot.send_message(message.chat.id, text, reply_markup=markup or MARKUP, parse_mode='HTML')
+    except Exception as e:
+        await bot.send_message(message.chat.id, 'Error: {}.'.format(str(e)), reply_markup=MARKUP)
+
+
+@bot.message_handler(commands=['export'])
+async def export(message):
+    command, *args = message.text.split()
+    export_format = args[0].lower().lstrip('.') if args else EXPORT_FORMATS[0]
+    if export_format not in EXPORT_FORMATS:
+        await bot.send_message(message.chat.id, 'Error: Unsupported export format.\nPlease choose one of: {}.'
+                               .format(', '.join(EXPORT_FORMATS)), reply_markup=MARKUP)
+        return
+
+    try:
+        with await run(spool_export, message.from_user.id, export_format) as file:
+            await bot.send_document(message.chat.id, file, visible_file_name='homework.' + export_format,
+                                    reply_markup=MARKUP)
+    except Exception as e:
+        await bot.send_message(message.chat.id, 'Error: {}.'.format(str(e)), reply_markup=MARKUP)
+
+
+@bot.message_handler(content_types=['document'])
+async def handle_document(message):
+    file_name = (message.document.file_name or '').lower()
+    if not file_name.endswith(('.xlsx', '.csv', '.ics')):
+        await bot.send_message(message.chat.id, 'Error: Unsupported file type.')
+        return
+
+    if message.document.file_size and message.document.file_size > MAX_UPLOAD_SIZE:
+        await bot.send_message(message.chat.id, 'Error: File is too large.')
+        return
+
+    file_info = await bot.get_file(message.document.file_id)
+    if not file_name.endswith('.xlsx'):
+        try:
+            content = await bot.download_file(file_info.file_path)
+            count = await run(import_homework, message.from_user.id, file_name, content)
+        except Exception as e:
+            await bot.send_message(message.chat.id, 'Error: {}.'.format(str(e)), reply_markup=MARKUP)
+        else:
+            await bot.send_message(message.chat.id, 'Imported homework items: {}.'.format(count),
+                                   reply_markup=MARKUP)
+        return
+
+    pending_uploads.set(message.from_user.id, await bot.download_file(file_info.file_path))
+
+    markup = ReplyKeyboardMarkup(resize_keyboard=True).add('Yes', 'No')
+    await run(conversations.start, message.from_user.id, CONFIRM_SCHEDULE)
+    await bot.send_message(message.chat.id, 'Are you sure you want to change your schedule?\n'
+                                            'This will delete all your recorded homework.', reply_markup=markup)
+
+
+async def handle_change_schedule_answer(message):
+    if message.text is None or message.text.lower() not in ('yes', 'no'):
+        await bot.send_message(message.chat.id, 'Error: Incorrect response.\nPlease choose one of the options.')
+        return
+
+    await run(conversations.finish, message.from_user.id)
+    file = pending_uploads.pop(message.from_user.id)
+
+    if message.text.lower() == 'yes':
+        if file is None:
+            await bot.send_message(message.chat.id, 'Error: Uploaded file has expired.\nPlease send it again.',
+                                   reply_markup=MARKUP)
+            return
+
+        try:
+            coalesced = import_queue.submit(message.from_user.id, message.chat.id, file)
+        except Exception as e:
+            await bot.send_message(message.chat.id, 'Error: {}.'.format(str(e)), reply_markup=MARKUP)
+        else:
+            await bot.send_message(message.chat.id, 'Your previous upload was replaced with this one.' if coalesced
+                                   else 'Your schedule was queued for import.', reply_markup=MARKUP)
+
+    else:
+        await bot.send_message(message.chat.id, "Schedule wasn't changed.", reply_markup=MARKUP)
+
+
+@bot.message_handler(content_types=['text'])
+async def handle_text(message):
+    try:
+        text = message.text.lower()
+        if text == 'today':
+            await bot.send_message(message.chat.id, await run(get_schedule, message.from_user.id, today()),
+                                   parse_mode='HTML')
+
+        elif text == 'tomorrow':
+            await bot.send_message(message.chat.id, await run(get_schedule, message.from_user.id, today() + 1),
+                                   parse_mode='HTML')
+
+        elif text == 'week':
+            date = today()
+            await send_schedules(message.chat.id, await run(get_schedule_range, message.from_user.id, date, date + 6))
+
+        elif text == 'all':
+            page, markup = await run(get_all_page, message.from_user.id)
+            if page is None:
+                await bot.send_message(message.chat.id, 'You have no recorded homework.')
+                return
+
+            await bot.send_message(message.chat.id, page, reply_markup=markup, parse_mode='HTML')
+
+        elif text == 'add':
+            subjects = await run(get_subjects, message.from_user.id)
+            markup = ReplyKeyboardMarkup(resize_keyboard=True).add(*subjects, row_width=1).add('❌ Cancel ❌')
+            await run(conversations.start, message.from_user.id, ADD_SUBJECT)
+            await bot.send_message(message.chat.id, 'Choose the subject.', reply_markup=markup)
+
+        elif text == 'delete':
+            markup, cursor = await run(get_dates_markup, message.from_user.id)
+            if markup is None:
+                await bot.send_message(message.chat.id, 'You have no recorded homework to delete.')
+                return
+
+            await run(conversations.start, message.from_user.id, DELETE_DATE, cursor=cursor)
+            await bot.send_message(message.chat.id, 'Choose the date of the homework you wish to delete.\n'
+                                                    '(Or type it as <b>DD.⁠MM</b>).',
+                                   reply_markup=markup, parse_mode='HTML')
+
+        else:
+            date = await process_date(message)
+            if date:
+                await bot.send_message(message.chat.id, await run(get_schedule, message.from_user.id, date),
+                                       parse_mode='HTML')
+            elif date is False:
+                await bot.send_message(message.chat.id, "Bot didn't understand you.", reply_markup=MARKUP)
+
+    except Exception as e:
+        await bot.send_message(message.chat.id, 'Error: {}.'.format(str(e)), reply_markup=MARKUP)
+
+
+async def handle_subject(message):
+    try:
+        if message.text is None:
+            await bot.send_message(message.chat.id, 'Error: Empty response.\nPlease choose one of the options.')
+            return
+
+        elif await check_cancel(message):
+            return
+
+        subjects = await run(get_subjects, message.from_user.id)
+
+        if message.text not in subjects:
+            await bot.send_message(message.chat.id, 'Error: Incorrect response.\nPlease choose one of the options.')
+            return
+
+        index = subjects.index(message.text)
+
+        next_lesson = await run(get_next_lesson_date, message.from_user.id, index)
+        markup = ReplyKeyboardMarkup(resize_keyboard=True).add('Next lesson: {}'.format(format_date(next_lesson))) \
+            .add('Today', 'Tomorrow')
+
+        start = today() + 2
+        ordinal_dates = await run(get_next_lessons, message.from_user.id, index, start, DEADLINE_BUTTONS)
+        if not ordinal_dates:
+            ordinal_dates = range(start, start + DEADLINE_BUTTONS)
+        dates = [format_date(ordinal_date) for ordinal_date in ordinal_dates]
+
+        markup.add(*dates, row_width=3).add('❌ Cancel ❌')
+        await run(conversations.advance, message.from_user.id, ADD_DATE, subject=index)
+        await bot.send_message(message.chat.id, 'Choose the deadline: press one of the buttons '
+                                                'or type your own date in <b>DD.⁠MM</b> format.',
+                               reply_markup=markup, parse_mode='HTML')
+
+    except Exception as e:
+        await run(conversations.finish, message.from_user.id)
+        await bot.send_message(message.chat.id, 'Error: {}.'.format(str(e)), reply_markup=MARKUP)
+
+
+async def handle_new_date(message):
+    try:
+        if message.text is None:
+            await bot.send_message(message.chat.id, 'Error: Empty date message.')
+            return
+
+        elif await check_cancel(message):
+            return
+
+        text = message.text.lower()
+        if text.startswith('next lesson'):
+            date = None
+        elif text == 'today':
+            date = today()
+        elif text == 'tomorrow':
+            date = today() + 1
+        else:
+            date = await process_date(message, retry=True)
+            if not date:
+                return
+
+        subject = (await run(conversations.get_data, message.from_user.id))['subject']
+        if date and await run(in_schedule, message.from_user.id, date, subject):
+            await run(conversations.advance, message.from_user.id, ADD_TYPE, date=date)
+            await bot.send_message(message.chat.id, 'Is this deadline set for the lesson or the end of the day?',
+                                   reply_markup=ReplyKeyboardMarkup(resize_keyboard=True)
+                                   .add('Lesson', 'Day').add('❌ Cancel ❌'))
+            return
+
+        await run(conversations.advance, message.from_user.id, ADD_DESCRIPTION, date=date, for_lesson=not date)
+        await bot.send_message(message.chat.id, 'Write homework description. Type <i>Cancel</i> to cancel adding the '
+                                                'homework.', reply_markup=ReplyKeyboardRemove(), parse_mode='HTML')
+
+    except Exception as e:
+        await run(conversations.finish, message.from_user.id)
+        await bot.send_message(message.chat.id, 'Error: {}.'.format(str(e)), reply_markup=MARKUP)
+
+
+async def handle_type(message):
+    try:
+        if message.text is None or message.text.lower() not in ('lesson', 'day', 'cancel', '❌ cancel ❌'):
+            await bot.send_message(message.chat.id, 'Error: Incorrect response.\nPlease choose one of the options.')
+            return
+
+        elif await check_cancel(message):
+            return
+
+        await run(conversations.advance, message.from_user.id, ADD_DESCRIPTION,
+                  for_lesson=message.text.lower() == 'lesson')
+        await bot.send_message(message.chat.id, 'Write homework description. Type <i>Cancel</i> to cancel adding the '
+                                                'homework.', reply_markup=ReplyKeyboardRemove(), parse_mode='HTML')
+
+    except Exception as e:
+        await run(conversations.finish, message.from_user.id)
+        await bot.send_message(message.chat.id, 'Error: {}.'.format(str(e)), reply_markup=MARKUP)
+
+
+async def handle_description(message):
+    try:
+        if message.text is None:
+            await bot.send_message(message.chat.id, 'Error: Empty description.')
+            return
+
+        elif await check_cancel(message):
+            return
+
+        conversation = await run(conversations.get_data, message.from_user.id)
+        await run(conversations.finish, message.from_user.id)
+        date = await run(add_homework, message.from_user.id, conversation['subject'], conversation['date'],
+                         conversation['for_lesson'], message.text)
+        await bot.send_message(message.chat.id, 'Homework successfully added:')
+        await bot.send_message(message.chat.id, await run(get_schedule, message.from_user.id, date),
+                               reply_markup=MARKUP, parse_mode='HTML')
+
+    except Exception as e:
+        await bot.send_message(message.chat.id, 'Error: {}.'.format(str(e)), reply_markup=MARKUP)
+
+
+async def handle_existing_date(message):
+    if message.text is None:
+        await bot.send_message(message.chat.id, 'Error: Empty date message.')
+        return
+
+    elif await check_cancel(message, adding=False):
+        return
+
+    text = message.text.lower()
+    cursor = (await run(conversations.get_data, message.from_user.id)).get('cursor')
+    if text == MORE_DATES.lower() and cursor is not None:
+        markup, cursor = await run(get_dates_markup, message.from_user.id, after=cursor)
+        if markup is None:
+            await bot.send_message(message.chat.id, 'You have no more recorded homework.\nChoose the date again.')
+            return
+
+        await run(conversations.start, message.from_user.id, DELETE_DATE, cursor=cursor)
+        await bot.send_message(message.chat.id, 'Choose the date of the homework you wish to delete.',
+                               reply_markup=markup)
+        return
+
+    if text == 'today':
+        date = today()
+    elif text == 'tomorrow':
+        date = today() + 1
+    else:
+        date = await process_date(message, retry=True)
+        if not date:
+            return
+
+    homework = await run(get_homework, message.from_user.id, date)
+    if not homework:
+        await bot.send_message(message.chat.id, 'You have no recorded homework for that date.\n'
+                                                'Choose the date again.')
+        return
+
+    await run(conversations.finish, message.from_user.id)
+    await bot.send_message(message.chat.id, 'Homework for {}:'.format(format_date(date)), reply_markup=MARKUP)
+    await bot.send_message(message.chat.id, 'Choose the homework to delete.',
+                           reply_markup=get_delete_markup(date, homework))
+
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith('delete:'))
+async def handle_delete_callback(call):
+    try:
+        if call.data == 'delete:cancel':
+            await bot.answer_callback_query(call.id)
+            await bot.edit_message_text('Homework deleting was cancelled.', call.message.chat.id,
+                                        call.message.message_id)
+            return
+
+        date, homework_ids = call.data.split(':')[1:]
+        deleted = await run(delete_homework, call.from_user.id,
+                            [int(homework_id) for homework_id in homework_ids.split(',')])
+        await bot.answer_callback_query(call.id, 'Deleted: {}'.format(deleted))
+        await bot.edit_message_text('Homework deleted successfully:\n\n' +
+                                    await run(get_schedule, call.from_user.id, int(date)),
+                                    call.message.chat.id, call.message.message_id, parse_mode='HTML')
+
+    except Exception as e:
+        await bot.answer_callback_query(call.id, 'Error: {}.'.format(str(e)), show_alert=True)
+
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith('all:'))
+async def handle_all_callback(call):
+    try:
+        direction, date = call.data.split(':')[1:]
+        if direction == 'prev':
+            text, markup = await run(get_all_page, call.from_user.id, before=int(date))
+        else:
+            text, markup = await run(get_all_page, call.from_user.id, after=int(date))
+
+        await bot.answer_callback_query(call.id)
+        await bot.edit_message_text(text or 'You have no recorded homework.', call.message.chat.id,
+                                    call.message.message_id, reply_markup=markup, parse_mode='HTML')
+
+    except Exception as e:
+        await bot.answer_callback_query(call.id, 'Error: {}.'.format(str(e)), show_alert=True)
+
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith('find:'))
+async def handle_find_callback(call):
+    try:
+        offset, query = call.data.split(':', 2)[1:]
+        text, markup = await run(get_find_page, call.from_user.id, query, int(offset))
+        await bot.answer_callback_query(call.id)
+        await bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup,
+                                    parse_mode='HTML')
+
+    except Exception as e:
+        await bot.answer_callback_query(call.id, 'Error: {}.'.format(str(e)), show_alert=True)
+
+
+STEP_HANDLERS = {
+    ADD_SUBJECT: handle_subject,
+    ADD_DATE: handle_new_date,
+    ADD_TYPE: handle_type,
+    ADD_DESCRIPTION: handle_description,
+    DELETE_DATE: handle_existing_date,
+    CONFIRM_SCHEDULE: handle_change_schedule_answer,
+}
+for state, handler in STEP_HANDLERS.items():
+    STEP_HANDLERS[state] = instrument_handler(handler)
+
+instrument_bot(bot)
+
+
+async def run_periodically(job, interval, executor=db_executor):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await run_in(executor, job)
+        except Exception:
+            logger.exception('Periodic job %s failed', job.__name__)
+
+
+async def main():
+    global import_queue
+    loop = asyncio.get_running_loop()
+
+    def notify(chat_id, text):
+        asyncio.run_coroutine_threadsafe(bot.send_message(chat_id, text, reply_markup=MARKUP), loop).result()
+
+    import_queue = ImportQueue(notify)
+    registry.gauge('import_queue_pending', lambda: len(import_queue.pending),
+                   'Schedule uploads waiting to be imported.')
+    start_server()
+
+    timers = [asyncio.create_task(run_periodically(delete_past_homework, interval=CLEANUP_INTERVAL)),
+              asyncio.create_task(run_periodically(conversations.evict, interval=EVICTION_INTERVAL)),
+              asyncio.create_task(run_periodically(pending_uploads.evict, interval=UPLOAD_EVICTION_INTERVAL)),
+              asyncio.create_task(run_periodically(notification_scheduler.run_pending, interval=TICK,
+                                                   executor=notification_executor))]
+    try:
+        await bot.polling(non_stop=True)
+    finally:
+        for timer in timers:
+            timer.cancel()
+        await asyncio.gather(*timers, return_exceptions=True)
+        import_queue.shutdown()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
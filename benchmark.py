@@ -0,0 +1,539 @@
+import argparse
+import datetime
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from io import BytesIO
+from itertools import islice
+
+from openpyxl import load_workbook
+
+SCALES = {
+    'small': (100, 8, 20),
+    'medium': (1000, 10, 50),
+    'large': (10000, 12, 100),
+}
+REPEAT = 200
+SCHEDULE_UPLOADS = 20
+SEARCH_ROWS = 1000000
+SEARCH_HOMEWORK = 100
+SEARCH_WORDS = 5000
+PARSERS = ('openpyxl', 'pandas')
+CONCURRENCY_SETUPS = ('writer', 'ad_hoc')
+CONCURRENT_READERS = 8
+CONCURRENT_WRITERS = 4
+CONCURRENCY_DURATION = 10
+DIGEST_BUILDERS = ('joined', 'per_user')
+FORM_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'files', 'form.xlsx')
+
+
+def percentile(samples, q):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(round(q / 100 * (len(samples) - 1))))]
+
+
+def peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def make_schedule(rng, subjects):
+    return [[[rng.randrange(subjects) if lesson < rng.randint(3, 7) else -1 for lesson in range(10)]
+             for week_day in range(6)] for week in range(2)]
+
+
+def make_form(rng, subjects):
+    workbook = load_workbook(FORM_PATH)
+    sheet = workbook.worksheets[0]
+    for index in range(subjects):
+        sheet.cell(row=2 + index, column=2, value='Subject {}'.format(index))
+        sheet.cell(row=2 + index, column=3, value='Teacher {}'.format(index) if index % 2 else None)
+        sheet.cell(row=2 + index, column=4, value='Room {}'.format(index) if index % 3 else None)
+
+    for first_column in (7, 15):
+        for week_day in range(6):
+            for lesson in range(rng.randint(3, 7)):
+                sheet.cell(row=3 + lesson, column=first_column + week_day, value=rng.randrange(subjects))
+
+    file = BytesIO()
+    workbook.save(file)
+    return file.getvalue()
+
+
+def make_words(rng, count):
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    return sorted(set(''.join(rng.choice(letters) for i in range(rng.randint(5, 10))) for j in range(count)))
+
+
+def populate(users, subjects, homework, today, seed=0, words=None):
+    from db import engine, User, Subject, Settings, Homework
+    from timetable import Timetable
+
+    rng = random.Random(seed)
+    if words:
+        describe = lambda index: ' '.join(rng.choice(words) for i in range(rng.randint(3, 8)))
+    else:
+        describe = lambda index: 'Exercise {} on page {}'.format(index, rng.randint(1, 300))
+
+    with engine.begin() as connection:
+        connection.execute(User.__table__.insert(), [
+            {'id': user_id, 'telegram_id': user_id,
+             'timetable': Timetable.from_schedule(make_schedule(rng, subjects)).to_bytes()}
+            for user_id in range(1, users + 1)])
+        connection.execute(Settings.__table__.insert(), [
+            {'user_id': user_id, 'language': 'en', 'timezone': rng.choice((3, 3, 3, 5, -5)), 'notification_time': 1080}
+            for user_id in range(1, users + 1)])
+        connection.execute(Subject.__table__.insert(), [
+            {'user_id': user_id, 'name': 'Subject {}'.format(index), 'teacher': 'Teacher {}'.format(index),
+             'room': str(100 + index)}
+            for user_id in range(1, users + 1) for index in range(subjects)])
+
+        rows = []
+        for user_id in range(1, users + 1):
+            for index in range(homework):
+                rows.append({'user_id': user_id, 'date': today + rng.randint(-3, 60),
+                             'subject': rng.randrange(subjects), 'for_lesson': rng.random() < 0.5,
+                             'description': describe(index)})
+            if len(rows) >= 100000:
+                connection.execute(Homework.__table__.insert(), rows)
+                rows = []
+
+        if rows:
+            connection.execute(Homework.__table__.insert(), rows)
+
+
+def add_past_homework(users, subjects, today):
+    from db import engine, Homework
+
+    with engine.begin() as connection:
+        connection.execute(Homework.__table__.insert(), [
+            {'user_id': user_id, 'date': today - 7, 'subject': user_id % subjects, 'for_lesson': False,
+             'description': 'Old exercise'} for user_id in range(1, users + 1)])
+
+
+class StatementCounter:
+    def __init__(self, engine):
+        from sqlalchemy import event
+
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self.increment)
+
+    def increment(self, *args):
+        self.count += 1
+
+
+def measure(name, function, repeat, counter, setup=None):
+    samples = []
+    statements = []
+    for i in range(repeat):
+        arguments = setup(i) if setup else ()
+        before = counter.count
+        start = time.perf_counter()
+        function(*arguments)
+        samples.append(time.perf_counter() - start)
+        statements.append(counter.count - before)
+
+    return {'name': name, 'calls': repeat, 'p50_ms': percentile(samples, 50) * 1000,
+            'p99_ms': percentile(samples, 99) * 1000, 'mean_ms': sum(samples) / repeat * 1000,
+            'statements': sum(statements) / repeat}
+
+
+def run_scale(users, subjects, homework, repeat, seed=0):
+    import planning
+    from db import engine
+
+    rng = random.Random(seed)
+    today = datetime.datetime.now(planning.TIMEZONE).date().toordinal()
+
+    start = time.perf_counter()
+    populate(users, subjects, homework, today, seed)
+    populated = time.perf_counter() - start
+
+    counter = StatementCounter(engine)
+    forms = [make_form(rng, subjects) for i in range(SCHEDULE_UPLOADS)]
+    random_user = lambda i: (rng.randint(1, users),)
+    random_day = lambda i: (rng.randint(1, users), today + rng.randint(0, 6))
+
+    def cold_day(i):
+        planning.schedule_cache.clear()
+        return random_day(i)
+
+    def past_homework(i):
+        add_past_homework(users, subjects, today)
+        return ()
+
+    def notifications():
+        for message in planning.get_notifications():
+            pass
+
+    results = [
+        measure('set_schedule', planning.set_schedule, SCHEDULE_UPLOADS, counter,
+                lambda i: (users + 1 + i, forms[i])),
+        measure('get_schedule', planning.get_schedule, repeat, counter, cold_day),
+        measure('get_schedule_cached', planning.get_schedule, repeat, counter, lambda i: (1, today)),
+        measure('get_dates', planning.get_dates, repeat, counter, random_user),
+        measure('get_homework', planning.get_homework, repeat, counter, random_day),
+        measure('get_notifications', notifications, max(1, repeat // 50), counter),
+        measure('delete_past_homework', planning.delete_past_homework, max(1, repeat // 50), counter,
+                past_homework),
+    ]
+
+    return {'users': users, 'subjects': subjects, 'homework': homework, 'populate_s': populated,
+            'results': results}
+
+
+def run_search(users, subjects, homework, repeat, seed=0):
+    from sqlalchemy import text
+
+    import planning
+    from db import Session, engine, get_snapshot
+
+    rng = random.Random(seed)
+    today = datetime.datetime.now(planning.TIMEZONE).date().toordinal()
+    words = make_words(rng, SEARCH_WORDS)
+
+    start = time.perf_counter()
+    populate(users, subjects, homework, today, seed, words)
+    populated = time.perf_counter() - start
+
+    counter = StatementCounter(engine)
+    random_query = lambda i: (rng.randint(1, users), rng.choice(words))
+
+    def like(user_id, word):
+        user = get_snapshot(user_id)
+        session = Session()
+        parameters = {'user_id': user.id, 'pattern': '%{}%'.format(word), 'limit': planning.SEARCH_PAGE_SIZE}
+        session.execute(text('SELECT count(*) FROM homework WHERE user_id = :user_id '
+                             'AND description LIKE :pattern'), parameters).scalar()
+        session.execute(text('SELECT date, subject, for_lesson, description FROM homework '
+                             'WHERE user_id = :user_id AND description LIKE :pattern '
+                             'ORDER BY date, id LIMIT :limit'), parameters).fetchall()
+        session.close()
+
+    def like_all(user_id, word):
+        session = Session()
+        session.execute(text('SELECT count(*) FROM homework WHERE description LIKE :pattern'),
+                        {'pattern': '%{}%'.format(word)}).scalar()
+        session.close()
+
+    def fts_all(user_id, word):
+        session = Session()
+        session.execute(text('SELECT count(*) FROM homework_search WHERE homework_search MATCH :match'),
+                        {'match': 'description : "{}"*'.format(word)}).scalar()
+        session.close()
+
+    results = [
+        measure('search_fts', lambda user_id, word: planning.search_homework(user_id, [word]), repeat, counter,
+                random_query),
+        measure('search_like', like, repeat, counter, random_query),
+        measure('search_fts_all_users', fts_all, max(1, repeat // 20), counter, random_query),
+        measure('search_like_all_users', like_all, max(1, repeat // 20), counter, random_query),
+    ]
+
+    return {'users': users, 'subjects': subjects, 'homework': homework, 'rows': users * homework,
+            'populate_s': populated, 'results': results}
+
+
+def parse_schedule_pandas(file):
+    from pandas import ExcelFile, isna
+    from db import MAX_LESSONS
+
+    file = ExcelFile(file)
+    df = file.parse(file.sheet_names[0])
+
+    subjects = []
+    for row in df[df.columns[1:4]].itertuples(index=False):
+        name, teacher, room = row
+        if not isna(name):
+            subjects.append((str(name), None if isna(teacher) else str(teacher), None if isna(room) else str(room)))
+
+    schedule = [[[], [], [], [], [], []], [[], [], [], [], [], []]]
+    for week, first_column in enumerate((6, 14)):
+        for week_day, (label, values) in enumerate(islice(df.items(), first_column, first_column + 6)):
+            for subject in values.iloc[1:MAX_LESSONS + 1]:
+                schedule[week][week_day].append(-1 if isna(subject) else int(subject))
+
+    return subjects, schedule
+
+
+def run_parse(parser, subjects, repeat, seed=0):
+    import planning
+
+    rng = random.Random(seed)
+    forms = [make_form(rng, subjects) for i in range(SCHEDULE_UPLOADS)]
+    rss_before = peak_rss_kb()
+
+    start = time.perf_counter()
+    if parser == 'pandas':
+        import pandas
+        parse = parse_schedule_pandas
+    else:
+        parse = planning.parse_schedule
+    imported = time.perf_counter() - start
+
+    expected = [planning.parse_schedule(form) for form in forms]
+    samples = []
+    for i in range(repeat):
+        index = i % len(forms)
+        start = time.perf_counter()
+        result = parse(BytesIO(forms[index]))
+        samples.append(time.perf_counter() - start)
+        if i < len(forms) and result != expected[index]:
+            raise AssertionError('{} parsed form {} differently'.format(parser, index))
+
+    return {'parser': parser, 'subjects': subjects, 'calls': repeat, 'import_s': imported,
+            'p50_ms': percentile(samples, 50) * 1000, 'p99_ms': percentile(samples, 99) * 1000,
+            'mean_ms': sum(samples) / repeat * 1000, 'rss_before_kb': rss_before, 'peak_rss_kb': peak_rss_kb()}
+
+
+def run_concurrency(setup, users, subjects, homework, seed=0, duration=CONCURRENCY_DURATION):
+    from sqlalchemy import create_engine
+    from sqlalchemy.exc import OperationalError
+    from sqlalchemy.orm import sessionmaker
+
+    import db
+    import planning
+    from db import Homework, User
+
+    rng = random.Random(seed)
+    today = datetime.datetime.now(planning.TIMEZONE).date().toordinal()
+    populate(users, subjects, homework, today, seed)
+
+    if setup == 'ad_hoc':
+        # the original setup: default engine, rollback journal and a session committed by every handler
+        path = db.engine.url.database + '.ad_hoc'
+        with db.engine.connect() as connection:
+            connection.exec_driver_sql("VACUUM INTO '{}'".format(path))
+        engine = create_engine('sqlite:///' + path)
+        with engine.connect() as connection:
+            connection.exec_driver_sql('PRAGMA journal_mode=DELETE')
+        Session = sessionmaker(bind=engine)
+
+        def write(job):
+            session = Session()
+            try:
+                job(session)
+                session.commit()
+            finally:
+                session.close()
+    else:
+        Session = db.Session
+        write = db.write
+
+    def read(thread_rng):
+        session = Session()
+        try:
+            session.query(Homework).filter_by(user_id=thread_rng.randint(1, users),
+                                              date=today + thread_rng.randint(0, 6)).all()
+        finally:
+            session.close()
+
+    def add(thread_rng):
+        user_id = thread_rng.randint(1, users)
+
+        def job(session):
+            session.query(User).filter_by(telegram_id=user_id).first()
+            session.add(Homework(user_id=user_id, date=today + thread_rng.randint(0, 6),
+                                 subject=thread_rng.randrange(subjects), for_lesson=False, description='Load test'))
+
+        write(job)
+
+    results = {'read': [], 'write': []}
+    errors = {}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def worker(kind, function, index):
+        thread_rng = random.Random('{}-{}-{}'.format(seed, kind, index))
+        samples = []
+        failures = {}
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                function(thread_rng)
+            except OperationalError as error:
+                reason = str(error.orig)
+                failures[reason] = failures.get(reason, 0) + 1
+            else:
+                samples.append(time.perf_counter() - start)
+
+        with lock:
+            results[kind].extend(samples)
+            for reason, count in failures.items():
+                errors[reason] = errors.get(reason, 0) + count
+
+    threads = [threading.Thread(target=worker, args=('read', read, index)) for index in range(CONCURRENT_READERS)]
+    threads += [threading.Thread(target=worker, args=('write', add, index)) for index in range(CONCURRENT_WRITERS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    report = {'setup': setup, 'users': users, 'homework': homework, 'readers': CONCURRENT_READERS,
+              'writers': CONCURRENT_WRITERS, 'duration_s': duration,
+              'locked_errors': errors.pop('database is locked', 0), 'other_errors': errors}
+    for kind, samples in results.items():
+        report[kind + 's'] = len(samples)
+        report[kind + 's_per_s'] = len(samples) / duration
+        report[kind + '_p50_ms'] = percentile(samples, 50) * 1000 if samples else None
+        report[kind + '_p99_ms'] = percentile(samples, 99) * 1000 if samples else None
+
+    return report
+
+
+def build_digests_per_user(today):
+    from db import Homework, Session, User, get_user
+
+    # the digest builder before the joined query: one session per user and two homework queries each
+    session = Session()
+    users = [(user.id, user.telegram_id) for user in session.query(User).all()]
+
+    result = []
+    for user_id, telegram_id in users:
+        user_session, user = get_user(telegram_id)
+        subjects = [s.name for s in user.subjects]
+        user_session.close()
+        if not subjects:
+            continue
+
+        text = ''
+        today_homework = session.query(Homework).filter_by(user_id=user_id, date=today, for_lesson=False) \
+            .order_by(Homework.subject).all()
+        if today_homework:
+            text += '<i>Today (until the end of the day):</i>\n'
+            subject = None
+            for h in today_homework:
+                if subject != h.subject:
+                    subject = h.subject
+                    text += '\n' + subjects[subject] + '\n'
+                text += '❗<b>{}</b>\n'.format(h.description)
+            text += '\n\n'
+
+        tomorrow_homework = session.query(Homework).filter_by(user_id=user_id, date=today + 1, for_lesson=True) \
+            .order_by(Homework.subject).all()
+        if tomorrow_homework:
+            text += '<i>Tomorrow (only for the lessons):</i>\n'
+            subject = None
+            for h in tomorrow_homework:
+                if subject != h.subject:
+                    subject = h.subject
+                    text += '\n' + subjects[subject] + '\n'
+                text += '❗<b>{}</b>\n'.format(h.description)
+
+        if text != '':
+            result.append((telegram_id, text))
+
+    session.close()
+
+    return result
+
+
+def run_digest(builder, users, subjects, homework, repeat, seed=0):
+    import planning
+    from db import engine
+
+    today = datetime.datetime.now(planning.TIMEZONE).date().toordinal()
+    start = time.perf_counter()
+    populate(users, subjects, homework, today, seed)
+    populated = time.perf_counter() - start
+
+    counter = StatementCounter(engine)
+    messages = [0]
+
+    def build():
+        if builder == 'per_user':
+            messages[0] = len(build_digests_per_user(today))
+        else:
+            messages[0] = sum(1 for message in planning.get_notifications(today=today))
+
+    result = measure('digest_' + builder, build, max(1, repeat // 50), counter)
+    return {'builder': builder, 'users': users, 'subjects': subjects, 'homework': homework,
+            'populate_s': populated, 'messages': messages[0], 'results': [result]}
+
+
+def run_child(name, arguments):
+    with tempfile.TemporaryDirectory() as directory:
+        environment = dict(os.environ, DATABASE_URL='sqlite:///' + os.path.join(directory, 'benchmark.sqlite3'))
+        environment.pop('DATABASE_ECHO', None)
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--child'] + [str(a) for a in arguments],
+                                env=environment, cwd=directory, check=True, stdout=subprocess.PIPE).stdout
+
+    return dict(json.loads(output), scale=name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark planning.py against a synthetic SQLite database.')
+    parser.add_argument('--scales', default=','.join(SCALES), help='comma-separated subset of: ' + ', '.join(SCALES))
+    parser.add_argument('--users', type=int, help='custom number of users (overrides --scales)')
+    parser.add_argument('--subjects', type=int, default=10)
+    parser.add_argument('--homework', type=int, default=50, help='homework items per user')
+    parser.add_argument('--repeat', type=int, default=REPEAT)
+    parser.add_argument('--seed', type=int, default=0)
+    modes = parser.add_mutually_exclusive_group()
+    modes.add_argument('--search', action='store_true',
+                       help='compare /find (FTS5) with a LIKE scan instead of running the scales')
+    modes.add_argument('--parse', action='store_true',
+                       help='compare time and peak RSS of the openpyxl and pandas schedule parsers')
+    modes.add_argument('--concurrency', action='store_true',
+                       help='run concurrent readers and writers through the writer queue and through ad-hoc sessions')
+    modes.add_argument('--digest', action='store_true',
+                       help='compare the joined notification digest with the per-user queries (10000 users)')
+    parser.add_argument('--search-rows', type=int, default=SEARCH_ROWS, help='homework rows for --search')
+    parser.add_argument('--duration', type=float, default=CONCURRENCY_DURATION,
+                        help='seconds per setup for --concurrency')
+    parser.add_argument('--variant', help=argparse.SUPPRESS)
+    parser.add_argument('--output', help='write the JSON report to this file instead of stdout')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        if args.search:
+            result = run_search(args.users, args.subjects, args.homework, args.repeat, args.seed)
+        elif args.parse:
+            result = run_parse(args.variant, args.subjects, args.repeat, args.seed)
+        elif args.concurrency:
+            result = run_concurrency(args.variant, args.users, args.subjects, args.homework, args.seed, args.duration)
+        elif args.digest:
+            result = run_digest(args.variant, args.users, args.subjects, args.homework, args.repeat, args.seed)
+        else:
+            result = run_scale(args.users, args.subjects, args.homework, args.repeat, args.seed)
+        json.dump(result, sys.stdout)
+        return
+
+    scale = lambda subjects, homework: ['--subjects', subjects, '--homework', homework, '--repeat', args.repeat,
+                                        '--seed', args.seed]
+    common = scale(args.subjects, args.homework)
+    if args.search:
+        children = {'search': ['--search', '--users', max(1, args.search_rows // SEARCH_HOMEWORK)] +
+                    scale(args.subjects, SEARCH_HOMEWORK)}
+    elif args.parse:
+        children = {parser_name: ['--parse', '--variant', parser_name] + common for parser_name in PARSERS}
+    elif args.concurrency:
+        children = {setup: ['--concurrency', '--variant', setup, '--users', args.users or SCALES['medium'][0],
+                            '--duration', args.duration] + common for setup in CONCURRENCY_SETUPS}
+    elif args.digest:
+        children = {builder: ['--digest', '--variant', builder, '--users', args.users or SCALES['large'][0]] + common
+                    for builder in DIGEST_BUILDERS}
+    elif args.users:
+        children = {'custom': ['--users', args.users] + common}
+    else:
+        children = {name: ['--users', SCALES[name][0]] + scale(*SCALES[name][1:]) for name in args.scales.split(',')}
+
+    report = {'python': sys.version.split()[0], 'created': datetime.datetime.now().isoformat(timespec='seconds'),
+              'repeat': args.repeat, 'scales': [run_child(name, arguments) for name, arguments in children.items()]}
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -5,23 +5,250 @@ from threading import Thread
 
 import schedule
 import telebot
-from telebot.types import ReplyKeyboardMarkup, ReplyKeyboardRemove
-
+from telebot import apihelper
+from telebot.types import InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, ReplyKeyboardRemove
+
+from cache import LRUCache
+from db import user_cache, writer
+from dispatcher import Dispatcher
+from imports import ImportQueue
+from metrics import registry, instrument_bot, instrument_handler, start_server
 from my_token import TOKEN
-from planning import SHORT_WEEK_DAYS, TIMEZONE, set_schedule, get_schedule, in_schedule, get_subjects, add_homework, \
-    get_dates, get_homework, delete_homework, delete_past_homework, get_notifications
+from planning import TIMEZONE, schedule_cache, get_schedule, get_schedule_range, in_schedule, get_subjects, \
+    get_next_lesson_date, get_next_lessons, format_date, add_homework, get_dates, get_date_labels, get_schedules, \
+    get_homework, delete_homework, delete_past_homework, get_notification_settings, set_notification_settings, \
+    SEARCH_PAGE_SIZE, get_search_terms, search_homework
+from scheduler import TICK, NotificationScheduler
+from state import ADD_SUBJECT, ADD_DATE, ADD_TYPE, ADD_DESCRIPTION, DELETE_DATE, CONFIRM_SCHEDULE, create_store
+from transfer import EXPORT_FORMATS, import_homework, spool_export
 
 MARKUP = ReplyKeyboardMarkup(resize_keyboard=True, row_width=4).add('Today', 'Tomorrow', 'Week', 'All') \
     .add('Add', 'Delete').add('Info', 'Form')
 
+START_TEXT = ('Welcome to <b>Homework Planning Bot</b>!\n'
+              'Type /info or /help to learn what it can do.')
+INFO_TEXT = ('This is <b>Homework Planning Bot</b>.\n'
+             'It can monitor your homework.\n'
+             'To set your schedule, attach .xlsx file with the specific structure.\n'
+             'To get the blank Excel form with this structure and the information '
+             'on how to fill it, type /form.\n'
+             'To view your schedule and homework, press <i>Today</i>, <i>Tomorrow</i>, '
+             '<i>Week</i> or <i>All</i> or type any future date in <b>DD.⁠MM</b> format.\n'
+             'To add new homework, press <i>Add</i> and follow instructions.\n'
+             'To delete existing homework, press <i>Delete</i>.\n'
+             'To find homework by words from its description or subject, type /find <b>words</b>.\n'
+             'To add many homework items at once, attach a .csv or .ics file. '
+             'To download your homework and timetable, type /export or /export ics.\n'
+             'You can cancel adding or deleting homework by typing <i>Cancel</i> or pressing '
+             'the corresponding button.\n'
+             'Homework reminders are sent every evening. To change their time or your time zone, '
+             'type /notify <b>HH:MM</b> or /timezone <b>UTC offset</b> (e.g. <i>/timezone +3</i>).')
+FORM_TEXT = ('Read and follow the instructions to set your schedule.\n'
+             'In this Excel file there are three main parts.\n'
+             'The first one (columns <b>A-D</b>) is for the list of all your subjects and '
+             'the other two (columns <b>F-L</b> and <b>N-T</b>) are for their order.\n\n'
+             'At first, you need to type your subjects into the column named <i>Subject</i>.\n'
+             "You can also add your teacher's name or specify the room where each subject "
+             "takes place, but this is optional.\n\n"
+             'At second, you need to specify their order.\n'
+             'It is done by typing indexes of your subjects (displayed in the leftmost column)'
+             ' into the cells of the tables labeled <i>Top (odd) week</i> and '
+             '<i>Bottom (even) week</i>.\n'
+             'If you have the same schedule for all 2 types of weeks, you have to fill '
+             'both of these tables with the exact same data.\n')
+
+MAX_MESSAGE_LENGTH = 4096
+DEADLINE_BUTTONS = 12
+DATE_BUTTONS = 15
+ALL_PAGE_DATES = 7
+MORE_DATES = 'More dates ➡️'
+MAX_CALLBACK_DATA = 64
+FIND_CALLBACK = 'find:{}:{}'
+MAX_FIND_OFFSET = 99999
+MAX_UPLOAD_SIZE = 1024 * 1024
+PENDING_UPLOADS = 256
+PENDING_UPLOAD_TTL = 15 * 60
+
+if os.environ.get('BOT_API_URL'):
+    apihelper.API_URL = os.environ['BOT_API_URL'].rstrip('/') + '/bot{0}/{1}'
+    apihelper.FILE_URL = os.environ['BOT_API_URL'].rstrip('/') + '/file/bot{0}/{1}'
+
 bot = telebot.TeleBot(TOKEN)
-data = {}
+dispatcher = Dispatcher(bot)
+notification_scheduler = NotificationScheduler(dispatcher)
+conversations = create_store()
+pending_uploads = LRUCache(maxsize=PENDING_UPLOADS, ttl=PENDING_UPLOAD_TTL)
+import_queue = ImportQueue(lambda chat_id, text: bot.send_message(chat_id, text, reply_markup=MARKUP))
+
+registry.gauge('writer_queue_depth', writer.queue.qsize, 'Jobs waiting for the database writer.')
+registry.gauge('import_queue_pending', lambda: len(import_queue.pending), 'Schedule uploads waiting to be imported.')
+registry.gauge('schedule_cache_size', lambda: schedule_cache.stats()['size'], 'Rendered days in the cache.')
+registry.gauge('schedule_cache_hit_rate', lambda: schedule_cache.stats()['hit_rate'],
+               'Share of rendered day lookups served from the cache.')
+registry.gauge('user_cache_hit_rate', lambda: user_cache.stats()['hit_rate'],
+               'Share of user snapshot lookups served from the cache.')
+
+
+def truncate_message(text, limit=MAX_MESSAGE_LENGTH):
+    if len(text) <= limit:
+        return text
+
+    text = text[:limit - len('…</b>')].rsplit('\n', 1)[0] + '…'
+    return text + '</b>' if text.count('<b>') > text.count('</b>') else text
+
+
+def pack_messages(texts, limit=MAX_MESSAGE_LENGTH, separator='\n'):
+    messages = []
+    current = ''
+    for text in texts:
+        text = truncate_message(text, limit)
+        if current and len(current) + len(separator) + len(text) > limit:
+            messages.append(current)
+            current = ''
+        current += separator + text if current else text
+
+    if current:
+        messages.append(current)
+
+    return messages
+
+
+def send_schedules(chat_id, schedules):
+    for text in pack_messages(schedules):
+        bot.send_message(chat_id, text, parse_mode='HTML')
+
+
+def fit_message(texts, limit=MAX_MESSAGE_LENGTH, separator='\n', from_end=False):
+    fitted = []
+    length = 0
+    for text in reversed(texts) if from_end else texts:
+        if fitted and length + len(separator) + len(text) > limit:
+            break
+        fitted.append(text)
+        length += len(text) + (len(separator) if len(fitted) > 1 else 0)
+
+    if from_end:
+        fitted.reverse()
+
+    if length > limit:
+        fitted = [truncate_message(fitted[0], limit)]
+
+    return fitted
+
+
+def get_all_page(user_id, after=None, before=None):
+    if before is not None:
+        dates = get_dates(user_id, ordinal=True, before=before, limit=ALL_PAGE_DATES)
+        if not dates:
+            return get_all_page(user_id)
+
+        texts = fit_message(get_schedules(user_id, dates), from_end=True)
+        dates = dates[len(dates) - len(texts):]
+        has_next = True
+    else:
+        dates = get_dates(user_id, ordinal=True, after=after, limit=ALL_PAGE_DATES + 1)
+        if not dates:
+            return get_all_page(user_id) if after is not None else (None, None)
+
+        texts = fit_message(get_schedules(user_id, dates[:ALL_PAGE_DATES]))
+        has_next = len(dates) > len(texts)
+        dates = dates[:len(texts)]
+
+    buttons = []
+    if get_dates(user_id, ordinal=True, before=dates[0], limit=1):
+        buttons.append(InlineKeyboardButton('⬅️ Prev', callback_data='all:prev:{}'.format(dates[0])))
+    if has_next:
+        buttons.append(InlineKeyboardButton('Next ➡️', callback_data='all:next:{}'.format(dates[-1])))
+
+    return '\n'.join(texts), InlineKeyboardMarkup().row(*buttons) if buttons else None
+
+
+def get_delete_markup(date, homework):
+    markup = InlineKeyboardMarkup(row_width=1)
+    markup.add(*[InlineKeyboardButton(text, callback_data='delete:{}:{}'.format(date, homework_id))
+                 for homework_id, text in homework])
+
+    delete_all = 'delete:{}:{}'.format(date, ','.join(str(homework_id) for homework_id, text in homework))
+    if len(homework) > 1 and len(delete_all) <= MAX_CALLBACK_DATA:
+        markup.add(InlineKeyboardButton('Delete all', callback_data=delete_all))
+
+    return markup.add(InlineKeyboardButton('❌ Cancel ❌', callback_data='delete:cancel'))
+
+
+def get_dates_markup(user_id, after=None):
+    dates = get_dates(user_id, ordinal=True, after=after, limit=DATE_BUTTONS + 1)
+    if not dates:
+        return None, None
+
+    cursor = dates[DATE_BUTTONS - 1] if len(dates) > DATE_BUTTONS else None
+    markup = ReplyKeyboardMarkup(resize_keyboard=True).add(*get_date_labels(dates[:DATE_BUTTONS]), row_width=3)
+    if cursor is not None:
+        markup.add(MORE_DATES)
+
+    return markup.add('❌ Cancel ❌'), cursor
+
+
+def fit_search_terms(terms):
+    terms = list(terms)
+    while len(terms) > 1 and len(FIND_CALLBACK.format(MAX_FIND_OFFSET, ' '.join(terms)).encode()) > MAX_CALLBACK_DATA:
+        terms.pop()
+
+    return terms
+
+
+def get_find_page(user_id, query, offset=0):
+    terms = fit_search_terms(get_search_terms(query))
+    total, results = search_homework(user_id, terms, offset)
+    if total and not results:
+        offset = (total - 1) // SEARCH_PAGE_SIZE * SEARCH_PAGE_SIZE
+        total, results = search_homework(user_id, terms, offset)
+
+    query = ' '.join(terms)
+    if not total:
+        return 'Nothing found for <i>{}</i>.'.format(query), None
+
+    text = ['Found {} homework items for <i>{}</i>:\n'.format(total, query)]
+    for number, (date, homework) in enumerate(results, start=offset + 1):
+        text.append('{}. {} — {}'.format(number, format_date(date), homework))
+
+    if total <= SEARCH_PAGE_SIZE:
+        return '\n'.join(text), None
+
+    text.append('\nPage {} of {}'.format(offset // SEARCH_PAGE_SIZE + 1, (total - 1) // SEARCH_PAGE_SIZE + 1))
+    buttons = []
+    if offset > 0:
+        buttons.append(InlineKeyboardButton('⬅️ Prev', callback_data=FIND_CALLBACK.format(
+            max(0, offset - SEARCH_PAGE_SIZE), query)))
+    if offset + SEARCH_PAGE_SIZE < total and offset + SEARCH_PAGE_SIZE <= MAX_FIND_OFFSET:
+        buttons.append(InlineKeyboardButton('Next ➡️', callback_data=FIND_CALLBACK.format(
+            offset + SEARCH_PAGE_SIZE, query)))
+
+    return '\n'.join(text), InlineKeyboardMarkup().row(*buttons)
+
+
+def parse_time(text):
+    hours, minutes = map(int, text.split(':'))
+    if not (0 <= hours < 24 and 0 <= minutes < 60):
+        raise ValueError('time must be between 00:00 and 23:59')
+
+    return hours * 60 + minutes
+
+
+def parse_timezone(text):
+    timezone = float(text.upper().replace('UTC', '') or 0)
+    if not (-12 <= timezone <= 14 and timezone * 4 == int(timezone * 4)):
+        raise ValueError('UTC offset must be between -12 and +14')
+
+    return timezone
+
+
+def format_notification_settings(timezone, notification_time):
+    return 'Reminders are sent at <b>{:02d}:{:02d}</b> (UTC{:+g}).'.format(*divmod(notification_time, 60), timezone)
 
 
 def check_cancel(message, adding=True):
     if message.text.lower() in ('cancel', '❌ cancel ❌'):
-        if message.from_user.id in data:
-            del data[message.from_user.id]
+        conversations.finish(message.from_user.id)
         bot.send_message(message.chat.id, 'Homework {} was cancelled.'.format('adding' if adding else 'deleting'),
                          reply_markup=MARKUP)
         return True
@@ -29,121 +256,162 @@ def check_cancel(message, adding=True):
     return False
 
 
-def process_date(message, function=None):
-    try:
-        text = message.text.split()[0].split('.')
-        day, month = map(int, text)
-        current_date = datetime.datetime.now(TIMEZONE).date()
-        current_month = current_date.month
-        if current_month < month + 6:
-            year = current_date.year
-        else:
-            year = current_date.year + 1
+def parse_date(text):
+    day, month = map(int, text.split()[0].split('.'))
+    current_date = datetime.datetime.now(TIMEZONE).date()
+    current_month = current_date.month
+    if current_month < month + 6:
+        year = current_date.year
+    else:
+        year = current_date.year + 1
 
-        date = datetime.date(year=year, month=month, day=day).toordinal()
-        if date < current_date.toordinal():
+    return datetime.date(year=year, month=month, day=day).toordinal()
+
+
+def process_date(message, retry=False):
+    try:
+        date = parse_date(message.text)
+        if date < datetime.datetime.now(TIMEZONE).date().toordinal():
             bot.send_message(message.chat.id, 'Error: Past date.\n'
                                               'Please enter a future or present date.')
-            if function:
-                bot.register_next_step_handler(message, function)
         else:
             return date
 
     except Exception as e:
-        if function:
+        if retry:
             bot.send_message(message.chat.id, 'Error: Incorrect date ({}).\n'
                                               'Make sure to type it in <b>DD.⁠MM</b> format.'.format(str(e)),
                              parse_mode='HTML')
-            bot.register_next_step_handler(message, function)
         return False
 
 
+@bot.message_handler(func=lambda message: conversations.get(message.from_user.id) is not None,
+                     content_types=['text', 'document', 'photo', 'audio', 'video', 'voice', 'sticker'])
+def handle_conversation(message):
+    handler = STEP_HANDLERS.get(conversations.get(message.from_user.id))
+    if handler:
+        handler(message)
+    else:
+        conversations.finish(message.from_user.id)
+
+
 @bot.message_handler(commands=['start'])
 @bot.message_handler(func=lambda message: message.text is not None and message.text.lower() == 'start')
 def start(message):
-    bot.send_message(message.chat.id, 'Welcome to <b>Homework Planning Bot</b>!\n'
-                                      'Type /info or /help to learn what it can do.',
-                     reply_markup=MARKUP, parse_mode='HTML')
+    bot.send_message(message.chat.id, START_TEXT, reply_markup=MARKUP, parse_mode='HTML')
 
 
 @bot.message_handler(commands=['info', 'help'])
 @bot.message_handler(func=lambda message: message.text is not None and message.text.lower() in ('info', 'help'))
 def info(message):
-    bot.send_message(message.chat.id, 'This is <b>Homework Planning Bot</b>.\n'
-                                      'It can monitor your homework.\n'
-                                      'To set your schedule, attach .xlsx file with the specific structure.\n'
-                                      'To get the blank Excel form with this structure and the information '
-                                      'on how to fill it, type /form.\n'
-                                      'To view your schedule and homework, press <i>Today</i>, <i>Tomorrow</i>, '
-                                      '<i>Week</i> or <i>All</i> or type any future date in <b>DD.⁠MM</b> format.\n'
-                                      'To add new homework, press <i>Add</i> and follow instructions.\n'
-                                      'To delete existing homework, press <i>Delete</i>.\n'
-                                      'You can cancel adding or deleting homework by typing <i>Cancel</i> or pressing '
-                                      'the corresponding button.', reply_markup=MARKUP, parse_mode='HTML')
+    bot.send_message(message.chat.id, INFO_TEXT, reply_markup=MARKUP, parse_mode='HTML')
 
 
 @bot.message_handler(commands=['form'])
 @bot.message_handler(func=lambda message: message.text is not None and message.text.lower() == 'form')
 def form(message):
-    bot.send_message(message.chat.id, 'Read and follow the instructions to set your schedule.\n'
-                                      'In this Excel file there are three main parts.\n'
-                                      'The first one (columns <b>A-D</b>) is for the list of all your subjects and '
-                                      'the other two (columns <b>F-L</b> and <b>N-T</b>) are for their order.\n\n'
-                                      'At first, you need to type your subjects into the column named <i>Subject</i>.\n'
-                                      "You can also add your teacher's name or specify the room where each subject "
-                                      "takes place, but this is optional.\n\n"
-                                      'At second, you need to specify their order.\n'
-                                      'It is done by typing indexes of your subjects (displayed in the leftmost column)'
-                                      ' into the cells of the tables labeled <i>Top (odd) week</i> and '
-                                      '<i>Bottom (even) week</i>.\n'
-                                      'If you have the same schedule for all 2 types of weeks, you have to fill '
-                                      'both of these tables with the exact same data.\n',
-                     reply_markup=MARKUP, parse_mode='HTML')
+    bot.send_message(message.chat.id, FORM_TEXT, reply_markup=MARKUP, parse_mode='HTML')
 
     with open('files/form.xlsx', mode='rb') as form_file:
         bot.send_document(message.chat.id, form_file)
 
 
+@bot.message_handler(commands=['notify', 'timezone'])
+def notification_settings(message):
+    command, *args = message.text.split()
+    try:
+        if args and command.startswith('/notify'):
+            set_notification_settings(message.from_user.id, notification_time=parse_time(args[0]))
+        elif args:
+            set_notification_settings(message.from_user.id, timezone=parse_timezone(args[0]))
+
+        bot.send_message(message.chat.id, format_notification_settings(*get_notification_settings(
+            message.from_user.id)), reply_markup=MARKUP, parse_mode='HTML')
+
+    except Exception as e:
+        bot.send_message(message.chat.id, 'Error: {}.'.format(str(e)), reply_markup=MARKUP)
+
+
+@bot.message_handler(commands=['find'])
+def find(message):
+    try:
+        text, markup = get_find_page(message.from_user.id, message.text.partition(' ')[2])
+        bot.send_message(message.chat.id, text, reply_markup=markup or MARKUP, parse_mode='HTML')
+    except Exception as e:
+        bot.send_message(message.chat.id, 'Error: {}.'.format(str(e)), reply_markup=MARKUP)
+
+
+@bot.message_handler(commands=['export'])
+def export(message):
+    command, *args = message.text.split()
+    export_format = args[0].lower().lstrip('.') if args else EXPORT_FORMATS[0]
+    if export_format not in EXPORT_FORMATS:
+        bot.send_message(message.chat.id, 'Error: Unsupported export format.\nPlease choose one of: {}.'
+                         .format(', '.join(EXPORT_FORMATS)), reply_markup=MARKUP)
+        return
+
+    try:
+        with spool_export(message.from_user.id, export_format) as file:
+            bot.send_document(message.chat.id, file, visible_file_name='homework.' + export_format,
+                              reply_markup=MARKUP)
+    except Exception as e:
+        bot.send_message(message.chat.id, 'Error: {}.'.format(str(e)), reply_markup=MARKUP)
+
+
 @bot.message_handler(content_types=['document'])
 def handle_document(message):
-    if not message.document.file_name.endswith('.xlsx'):
+    file_name = (message.document.file_name or '').lower()
+    if not file_name.endswith(('.xlsx', '.csv', '.ics')):
         bot.send_message(message.chat.id, 'Error: Unsupported file type.')
         return
 
+    if message.document.file_size and message.document.file_size > MAX_UPLOAD_SIZE:
+        bot.send_message(message.chat.id, 'Error: File is too large.')
+        return
+
     file_info = bot.get_file(message.document.file_id)
-    file = bot.download_file(file_info.file_path)
-    path = 'files/' + str(message.from_user.id) + '.xlsx'
-    with open(path, 'wb') as new_file:
-        new_file.write(file)
+    if not file_name.endswith('.xlsx'):
+        try:
+            count = import_homework(message.from_user.id, file_name, bot.download_file(file_info.file_path))
+        except Exception as e:
+            bot.send_message(message.chat.id, 'Error: {}.'.format(str(e)), reply_markup=MARKUP)
+        else:
+            bot.send_message(message.chat.id, 'Imported homework items: {}.'.format(count), reply_markup=MARKUP)
+        return
+
+    pending_uploads.set(message.from_user.id, bot.download_file(file_info.file_path))
 
     markup = ReplyKeyboardMarkup(resize_keyboard=True).add('Yes', 'No')
+    conversations.start(message.from_user.id, CONFIRM_SCHEDULE)
     bot.send_message(message.chat.id, 'Are you sure you want to change your schedule?\n'
                                       'This will delete all your recorded homework.', reply_markup=markup)
-    bot.register_next_step_handler(message, handle_change_schedule_answer)
 
 
 def handle_change_schedule_answer(message):
     if message.text is None or message.text.lower() not in ('yes', 'no'):
         bot.send_message(message.chat.id, 'Error: Incorrect response.\nPlease choose one of the options.')
-        bot.register_next_step_handler(message, handle_change_schedule_answer)
         return
 
-    path = 'files/' + str(message.from_user.id) + '.xlsx'
+    conversations.finish(message.from_user.id)
+    file = pending_uploads.pop(message.from_user.id)
 
     if message.text.lower() == 'yes':
+        if file is None:
+            bot.send_message(message.chat.id, 'Error: Uploaded file has expired.\nPlease send it again.',
+                             reply_markup=MARKUP)
+            return
+
         try:
-            with open(path, 'rb') as file:
-                set_schedule(message.from_user.id, file)
+            coalesced = import_queue.submit(message.from_user.id, message.chat.id, file)
         except Exception as e:
             bot.send_message(message.chat.id, 'Error: {}.'.format(str(e)), reply_markup=MARKUP)
         else:
-            bot.send_message(message.chat.id, 'New schedule successfully set.', reply_markup=MARKUP)
+            bot.send_message(message.chat.id, 'Your previous upload was replaced with this one.' if coalesced else
+                             'Your schedule was queued for import.', reply_markup=MARKUP)
 
     else:
         bot.send_message(message.chat.id, "Schedule wasn't changed.", reply_markup=MARKUP)
 
-    os.remove(path)
-
 
 @bot.message_handler(content_types=['text'])
 def handle_text(message):
@@ -159,35 +427,31 @@ def handle_text(message):
 
         elif text == 'week':
             date = datetime.datetime.now(TIMEZONE).date().toordinal()
-            for i in range(7):
-                bot.send_message(message.chat.id, get_schedule(message.from_user.id, date), parse_mode='HTML')
-                date += 1
+            send_schedules(message.chat.id, get_schedule_range(message.from_user.id, date, date + 6))
 
         elif text == 'all':
-            dates = get_dates(message.from_user.id, ordinal=True)
-            if not dates:
+            page, markup = get_all_page(message.from_user.id)
+            if page is None:
                 bot.send_message(message.chat.id, 'You have no recorded homework.')
                 return
 
-            for date in dates:
-                bot.send_message(message.chat.id, get_schedule(message.from_user.id, date), parse_mode='HTML')
+            bot.send_message(message.chat.id, page, reply_markup=markup, parse_mode='HTML')
 
         elif text == 'add':
             subjects = get_subjects(message.from_user.id)
             markup = ReplyKeyboardMarkup(resize_keyboard=True).add(*subjects, row_width=1).add('❌ Cancel ❌')
+            conversations.start(message.from_user.id, ADD_SUBJECT)
             bot.send_message(message.chat.id, 'Choose the subject.', reply_markup=markup)
-            bot.register_next_step_handler(message, handle_subject)
 
         elif text == 'delete':
-            dates = get_dates(message.from_user.id)
-            if not dates:
+            markup, cursor = get_dates_markup(message.from_user.id)
+            if markup is None:
                 bot.send_message(message.chat.id, 'You have no recorded homework to delete.')
                 return
 
-            markup = ReplyKeyboardMarkup(resize_keyboard=True).add(*dates, row_width=3).add('❌ Cancel ❌')
+            conversations.start(message.from_user.id, DELETE_DATE, cursor=cursor)
             bot.send_message(message.chat.id, 'Choose the date of the homework you wish to delete.\n'
                                               '(Or type it as <b>DD.⁠MM</b>).', reply_markup=markup, parse_mode='HTML')
-            bot.register_next_step_handler(message, handle_existing_date)
 
         else:
             date = process_date(message)
@@ -204,7 +468,6 @@ def handle_subject(message):
     try:
         if message.text is None:
             bot.send_message(message.chat.id, 'Error: Empty response.\nPlease choose one of the options.')
-            bot.register_next_step_handler(message, handle_subject)
             return
 
         elif check_cancel(message):
@@ -214,28 +477,27 @@ def handle_subject(message):
 
         if message.text not in subjects:
             bot.send_message(message.chat.id, 'Error: Incorrect response.\nPlease choose one of the options.')
-            bot.register_next_step_handler(message, handle_subject)
             return
 
         index = subjects.index(message.text)
-        data[message.from_user.id] = [index]
 
-        ordinal_date = datetime.datetime.now(TIMEZONE).date().toordinal() + 1
-        markup = ReplyKeyboardMarkup(resize_keyboard=True).add('Next lesson').add('Today', 'Tomorrow')
-        dates = []
-        for i in range(12):
-            ordinal_date += 1
-            date = datetime.date.fromordinal(ordinal_date)
-            dates.append('{}.{} ({})'.format(str(date.day).zfill(2), str(date.month).zfill(2),
-                                             SHORT_WEEK_DAYS[date.weekday()]))
+        next_lesson = 'Next lesson: {}'.format(format_date(get_next_lesson_date(message.from_user.id, index)))
+        markup = ReplyKeyboardMarkup(resize_keyboard=True).add(next_lesson).add('Today', 'Tomorrow')
+
+        start = datetime.datetime.now(TIMEZONE).date().toordinal() + 2
+        ordinal_dates = get_next_lessons(message.from_user.id, index, start, DEADLINE_BUTTONS)
+        if not ordinal_dates:
+            ordinal_dates = range(start, start + DEADLINE_BUTTONS)
+        dates = [format_date(ordinal_date) for ordinal_date in ordinal_dates]
 
         markup.add(*dates, row_width=3).add('❌ Cancel ❌')
+        conversations.advance(message.from_user.id, ADD_DATE, subject=index)
         bot.send_message(message.chat.id, 'Choose the deadline: press one of the buttons '
                                           'or type your own date in <b>DD.⁠MM</b> format.',
                          reply_markup=markup, parse_mode='HTML')
-        bot.register_next_step_handler(message, handle_new_date)
 
     except Exception as e:
+        conversations.finish(message.from_user.id)
         bot.send_message(message.chat.id, 'Error: {}.'.format(str(e)), reply_markup=MARKUP)
 
 
@@ -243,45 +505,37 @@ def handle_new_date(message):
     try:
         if message.text is None:
             bot.send_message(message.chat.id, 'Error: Empty date message.')
-            bot.register_next_step_handler(message, handle_new_date)
             return
 
         elif check_cancel(message):
             return
 
         text = message.text.lower()
-        if text == 'next lesson':
-            data[message.from_user.id].append(None)
+        if text.startswith('next lesson'):
+            date = None
         elif text == 'today':
             date = datetime.datetime.now(TIMEZONE).date().toordinal()
-            data[message.from_user.id].append(date)
         elif text == 'tomorrow':
             date = datetime.datetime.now(TIMEZONE).date().toordinal() + 1
-            data[message.from_user.id].append(date)
         else:
-            date = process_date(message, handle_new_date)
+            date = process_date(message, retry=True)
             if not date:
                 return
 
-            data[message.from_user.id].append(date)
-
-        subject, date = data[message.from_user.id]
+        subject = conversations.get_data(message.from_user.id)['subject']
         if date and in_schedule(message.from_user.id, date, subject):
+            conversations.advance(message.from_user.id, ADD_TYPE, date=date)
             bot.send_message(message.chat.id, 'Is this deadline set for the lesson or the end of the day?',
                              reply_markup=ReplyKeyboardMarkup(resize_keyboard=True)
                              .add('Lesson', 'Day').add('❌ Cancel ❌'))
-            bot.register_next_step_handler(message, handle_type)
             return
-        elif date:
-            data[message.from_user.id].append(False)
-        else:
-            data[message.from_user.id].append(True)
 
+        conversations.advance(message.from_user.id, ADD_DESCRIPTION, date=date, for_lesson=not date)
         bot.send_message(message.chat.id, 'Write homework description. Type <i>Cancel</i> to cancel adding the '
                                           'homework.', reply_markup=ReplyKeyboardRemove(), parse_mode='HTML')
-        bot.register_next_step_handler(message, handle_description)
 
     except Exception as e:
+        conversations.finish(message.from_user.id)
         bot.send_message(message.chat.id, 'Error: {}.'.format(str(e)), reply_markup=MARKUP)
 
 
@@ -289,23 +543,17 @@ def handle_type(message):
     try:
         if message.text is None or message.text.lower() not in ('lesson', 'day', 'cancel', '❌ cancel ❌'):
             bot.send_message(message.chat.id, 'Error: Incorrect response.\nPlease choose one of the options.')
-            bot.register_next_step_handler(message, handle_type)
             return
 
         elif check_cancel(message):
             return
 
-        text = message.text.lower()
-        if text == 'lesson':
-            data[message.from_user.id].append(True)
-        elif text == 'day':
-            data[message.from_user.id].append(False)
-
+        conversations.advance(message.from_user.id, ADD_DESCRIPTION, for_lesson=message.text.lower() == 'lesson')
         bot.send_message(message.chat.id, 'Write homework description. Type <i>Cancel</i> to cancel adding the '
                                           'homework.', reply_markup=ReplyKeyboardRemove(), parse_mode='HTML')
-        bot.register_next_step_handler(message, handle_description)
 
     except Exception as e:
+        conversations.finish(message.from_user.id)
         bot.send_message(message.chat.id, 'Error: {}.'.format(str(e)), reply_markup=MARKUP)
 
 
@@ -313,14 +561,15 @@ def handle_description(message):
     try:
         if message.text is None:
             bot.send_message(message.chat.id, 'Error: Empty description.')
-            bot.register_next_step_handler(message, handle_description)
             return
 
         elif check_cancel(message):
             return
 
-        subject, date, for_lesson = data.pop(message.from_user.id)
-        date = add_homework(message.from_user.id, subject, date, for_lesson, message.text)
+        conversation = conversations.get_data(message.from_user.id)
+        conversations.finish(message.from_user.id)
+        date = add_homework(message.from_user.id, conversation['subject'], conversation['date'],
+                            conversation['for_lesson'], message.text)
         bot.send_message(message.chat.id, 'Homework successfully added:')
         bot.send_message(message.chat.id, get_schedule(message.from_user.id, date),
                          reply_markup=MARKUP, parse_mode='HTML')
@@ -332,68 +581,102 @@ def handle_description(message):
 def handle_existing_date(message):
     if message.text is None:
         bot.send_message(message.chat.id, 'Error: Empty date message.')
-        bot.register_next_step_handler(message, handle_existing_date)
         return
 
     elif check_cancel(message, adding=False):
         return
 
     text = message.text.lower()
+    cursor = conversations.get_data(message.from_user.id).get('cursor')
+    if text == MORE_DATES.lower() and cursor is not None:
+        markup, cursor = get_dates_markup(message.from_user.id, after=cursor)
+        if markup is None:
+            bot.send_message(message.chat.id, 'You have no more recorded homework.\nChoose the date again.')
+            return
+
+        conversations.start(message.from_user.id, DELETE_DATE, cursor=cursor)
+        bot.send_message(message.chat.id, 'Choose the date of the homework you wish to delete.', reply_markup=markup)
+        return
+
     if text == 'today':
         date = datetime.datetime.now(TIMEZONE).date().toordinal()
     elif text == 'tomorrow':
         date = datetime.datetime.now(TIMEZONE).date().toordinal() + 1
     else:
-        date = process_date(message, handle_existing_date)
+        date = process_date(message, retry=True)
         if not date:
             return
 
     homework = get_homework(message.from_user.id, date)
     if not homework:
         bot.send_message(message.chat.id, 'You have no recorded homework for that date.\nChoose the date again.')
-        bot.register_next_step_handler(message, handle_existing_date)
         return
 
-    data[message.from_user.id] = date
-    markup = ReplyKeyboardMarkup(resize_keyboard=True).add(*homework, row_width=1).add('❌ Cancel ❌')
-    bot.send_message(message.chat.id, 'Choose the homework to delete.', reply_markup=markup)
-    bot.register_next_step_handler(message, handle_homework)
+    conversations.finish(message.from_user.id)
+    bot.send_message(message.chat.id, 'Homework for {}:'.format(format_date(date)), reply_markup=MARKUP)
+    bot.send_message(message.chat.id, 'Choose the homework to delete.', reply_markup=get_delete_markup(date, homework))
 
 
-def handle_homework(message):
-    if message.text is None:
-        bot.send_message(message.chat.id, 'Error: Empty homework message.')
-        bot.register_next_step_handler(message, handle_homework)
-        return
+@bot.callback_query_handler(func=lambda call: call.data.startswith('delete:'))
+def handle_delete_callback(call):
+    try:
+        if call.data == 'delete:cancel':
+            bot.answer_callback_query(call.id)
+            bot.edit_message_text('Homework deleting was cancelled.', call.message.chat.id, call.message.message_id)
+            return
 
-    elif check_cancel(message, adding=False):
-        return
+        date, homework_ids = call.data.split(':')[1:]
+        deleted = delete_homework(call.from_user.id, [int(homework_id) for homework_id in homework_ids.split(',')])
+        bot.answer_callback_query(call.id, 'Deleted: {}'.format(deleted))
+        bot.edit_message_text('Homework deleted successfully:\n\n' + get_schedule(call.from_user.id, int(date)),
+                              call.message.chat.id, call.message.message_id, parse_mode='HTML')
+
+    except Exception as e:
+        bot.answer_callback_query(call.id, 'Error: {}.'.format(str(e)), show_alert=True)
 
-    elif message.from_user.id not in data:
-        bot.send_message(message.chat.id, 'Error: Date was lost.\n'
-                                          'Please try starting over.', reply_markup=MARKUP)
-        return
 
+@bot.callback_query_handler(func=lambda call: call.data.startswith('all:'))
+def handle_all_callback(call):
     try:
-        date = delete_homework(message.from_user.id, data[message.from_user.id], message.text)
-        bot.send_message(message.chat.id, 'Homework deleted successfully:', reply_markup=MARKUP)
-        bot.send_message(message.chat.id, get_schedule(message.from_user.id, date),
-                         reply_markup=MARKUP, parse_mode='HTML')
-        del data[message.from_user.id]
+        direction, date = call.data.split(':')[1:]
+        if direction == 'prev':
+            text, markup = get_all_page(call.from_user.id, before=int(date))
+        else:
+            text, markup = get_all_page(call.from_user.id, after=int(date))
+
+        bot.answer_callback_query(call.id)
+        bot.edit_message_text(text or 'You have no recorded homework.', call.message.chat.id,
+                              call.message.message_id, reply_markup=markup, parse_mode='HTML')
 
     except Exception as e:
-        bot.send_message(message.chat.id, 'Error: {}.\n'
-                                          'Choose the homework you want to delete again.'.format(e))
-        bot.register_next_step_handler(message, handle_homework)
+        bot.answer_callback_query(call.id, 'Error: {}.'.format(str(e)), show_alert=True)
 
 
-def send_notifications():
-    notifications = get_notifications()
-    if not notifications:
-        return
+@bot.callback_query_handler(func=lambda call: call.data.startswith('find:'))
+def handle_find_callback(call):
+    try:
+        offset, query = call.data.split(':', 2)[1:]
+        text, markup = get_find_page(call.from_user.id, query, int(offset))
+        bot.answer_callback_query(call.id)
+        bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup,
+                              parse_mode='HTML')
+
+    except Exception as e:
+        bot.answer_callback_query(call.id, 'Error: {}.'.format(str(e)), show_alert=True)
 
-    for n in notifications:
-        bot.send_message(n[0], n[1], parse_mode='HTML')
+
+STEP_HANDLERS = {
+    ADD_SUBJECT: handle_subject,
+    ADD_DATE: handle_new_date,
+    ADD_TYPE: handle_type,
+    ADD_DESCRIPTION: handle_description,
+    DELETE_DATE: handle_existing_date,
+    CONFIRM_SCHEDULE: handle_change_schedule_answer,
+}
+for state, handler in STEP_HANDLERS.items():
+    STEP_HANDLERS[state] = instrument_handler(handler)
+
+instrument_bot(bot)
 
 
 def main():
@@ -402,13 +685,17 @@ def main():
 
 def timer():
     schedule.every().day.do(delete_past_homework)
-    schedule.every().day.at('18:00').do(send_notifications)
+    schedule.every().hour.do(conversations.evict)
+    schedule.every().minute.do(pending_uploads.evict)
+    schedule.every(TICK).seconds.do(notification_scheduler.run_pending)
     while True:
         schedule.run_pending()
         time.sleep(1)
 
 
 if __name__ == '__main__':
+    start_server()
+
     bot_thread = Thread(target=main, name='BotThread')
     timer_thread = Thread(target=timer, name='TimerThread')
 
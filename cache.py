@@ -0,0 +1,116 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.items.get(key)
+            if item is not None:
+                value, expires = item
+                if expires is None or expires > time.monotonic():
+                    self.items.move_to_end(key)
+                    self.hits += 1
+                    return value
+
+                del self.items[key]
+
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self.lock:
+            self.items[key] = (value, expires)
+            self.items.move_to_end(key)
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            item = self.items.pop(key, None)
+
+        if item is None or (item[1] is not None and item[1] <= time.monotonic()):
+            return default
+
+        return item[0]
+
+    def invalidate(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+    def evict(self):
+        now = time.monotonic()
+        with self.lock:
+            expired = [key for key, (value, expires) in self.items.items() if expires is not None and expires <= now]
+            for key in expired:
+                del self.items[key]
+
+        return len(expired)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def stats(self):
+        with self.lock:
+            requests = self.hits + self.misses
+            return {'size': len(self.items), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hits / requests if requests else 0.0}
+
+
+class VersionedCache:
+    def __init__(self, maxsize=1024):
+        self.cache = LRUCache(maxsize=maxsize)
+        self.epoch = 0
+        self.versions = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def version(self, owner):
+        with self.lock:
+            return self.epoch, self.versions.get(owner, 0)
+
+    def get(self, owner, key, default=None):
+        item = self.cache.get((owner, key))
+        version = self.version(owner)
+        with self.lock:
+            if item is not None and item[0] == version:
+                self.hits += 1
+                return item[1]
+
+            self.misses += 1
+            return default
+
+    def set(self, owner, key, value, version):
+        self.cache.set((owner, key), (version, value))
+
+    def bump(self, owner=None):
+        with self.lock:
+            if owner is None:
+                self.epoch += 1
+            else:
+                self.versions[owner] = self.versions.get(owner, 0) + 1
+
+    def clear(self):
+        self.cache.clear()
+        self.bump()
+
+    def stats(self):
+        with self.lock:
+            requests = self.hits + self.misses
+            return {'size': len(self.cache), 'maxsize': self.cache.maxsize, 'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hits / requests if requests else 0.0}
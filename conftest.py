@@ -0,0 +1,6 @@
+import os
+import tempfile
+
+DATABASE_DIRECTORY = tempfile.mkdtemp(prefix='homework-tests-')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(DATABASE_DIRECTORY, 'test.sqlite3')
+os.environ.pop('DATABASE_ECHO', None)
@@ -1,8 +1,25 @@
-from sqlalchemy import Column, Integer, JSON, String, Float, Boolean, ForeignKey, create_engine
+import os
+from collections import namedtuple
+
+from sqlalchemy import Column, Integer, LargeBinary, String, Float, Boolean, ForeignKey, Index, create_engine, event, \
+    inspect
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, sessionmaker
-
-MAX_LESSONS = 10
+from sqlalchemy.pool import QueuePool
+
+from cache import LRUCache
+from migrations import migrate
+from writer import Writer
+from timetable import MAX_LESSONS, Timetable
+
+USER_CACHE_SIZE = 4096
+USER_CACHE_TTL = 600
+DATABASE_URL = os.environ.get('DATABASE_URL', 'sqlite:///files/db.sqlite3')
+POOL_SIZE = 8
+CACHE_SIZE_KB = 16 * 1024
+BUSY_TIMEOUT = 30
+DEFAULT_TIMEZONE = 3
+NOTIFICATION_TIME = 18 * 60
 
 Base = declarative_base()
 
@@ -13,7 +30,7 @@ class User(Base):
     id = Column(Integer, primary_key=True)
     telegram_id = Column(Integer, unique=True)
     subjects = relationship('Subject', cascade='all, delete-orphan')
-    schedule = Column(JSON)
+    timetable = Column(LargeBinary)
     settings = relationship('Settings', uselist=False, back_populates='user')
     homework = relationship('Homework', cascade='all, delete-orphan')
 
@@ -31,6 +48,8 @@ class Subject(Base):
 
     user_id = Column(Integer, ForeignKey('user.id'))
 
+    __table_args__ = (Index('ix_subject_user', 'user_id', 'id'),)
+
     def __repr__(self):
         return 'Subject "{}"'.format(self.name)
 
@@ -41,12 +60,16 @@ class Settings(Base):
     id = Column(Integer, primary_key=True)
     language = Column(String, nullable=False)
     timezone = Column(Float, nullable=False)
+    notification_time = Column(Integer, nullable=False, default=NOTIFICATION_TIME)
 
     user_id = Column(Integer, ForeignKey('user.id'))
     user = relationship('User', back_populates='settings')
 
+    __table_args__ = (Index('ix_settings_notification', 'timezone', 'notification_time'),)
+
     def __repr__(self):
-        return 'Language: "{}", timezone: {}'.format(self.language, self.timezone)
+        return 'Language: "{}", timezone: {}, notifications at {:02d}:{:02d}'.format(
+            self.language, self.timezone, *divmod(self.notification_time, 60))
 
 
 class Homework(Base):
@@ -60,21 +83,52 @@ class Homework(Base):
 
     user_id = Column(Integer, ForeignKey('user.id'))
 
+    __table_args__ = (Index('ix_homework_user_date', 'user_id', 'date', 'for_lesson', 'subject'),
+                      Index('ix_homework_date', 'date', 'for_lesson'))
+
     def __repr__(self):
         return 'Homework "{}"'.format(self.description)
 
 
-engine = create_engine('sqlite:///files/db.sqlite3', echo=True)
+class Conversation(Base):
+    __tablename__ = 'conversation'
+
+    telegram_id = Column(Integer, primary_key=True)
+    state = Column(String, nullable=False)
+    data = Column(String, nullable=False)
+    updated = Column(Float, nullable=False, index=True)
+
+    def __repr__(self):
+        return 'Conversation of {} in state "{}"'.format(self.telegram_id, self.state)
+
+
+engine = create_engine(DATABASE_URL, echo=bool(os.environ.get('DATABASE_ECHO')), poolclass=QueuePool,
+                       pool_size=POOL_SIZE, max_overflow=POOL_SIZE,
+                       connect_args={'check_same_thread': False, 'timeout': BUSY_TIMEOUT})
+
+
+@event.listens_for(engine, 'connect')
+def set_sqlite_pragmas(connection, record):
+    cursor = connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA cache_size=-{:d}'.format(CACHE_SIZE_KB))
+    cursor.close()
+
+
+fresh = not inspect(engine).has_table(User.__tablename__)
 Base.metadata.create_all(engine)
+migrate(engine, fresh)
 
 Session = sessionmaker(bind=engine)
+writer = Writer(Session)
 
 
 def get_user(user_id):
     session = Session()
     q = session.query(User).filter_by(telegram_id=user_id)
     if not session.query(q.exists()).scalar():
-        settings = Settings(language='en', timezone=3)
+        settings = Settings(language='en', timezone=DEFAULT_TIMEZONE, notification_time=NOTIFICATION_TIME)
         user = User(telegram_id=user_id, settings=settings)
         session.add(user)
         session.commit()
@@ -82,3 +136,33 @@ def get_user(user_id):
         user = q.first()
 
     return session, user
+
+
+SubjectInfo = namedtuple('SubjectInfo', ['name', 'teacher', 'room'])
+UserSnapshot = namedtuple('UserSnapshot', ['id', 'telegram_id', 'subjects', 'schedule'])
+
+user_cache = LRUCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+
+
+def get_snapshot(user_id):
+    snapshot = user_cache.get(user_id)
+    if snapshot is not None:
+        return snapshot
+
+    session, user = get_user(user_id)
+    subjects = tuple(SubjectInfo(s.name, s.teacher, s.room) for s in user.subjects)
+    schedule = Timetable.from_bytes(user.timetable) if user.timetable else None
+    snapshot = UserSnapshot(user.id, user.telegram_id, subjects, schedule)
+    session.close()
+
+    user_cache.set(user_id, snapshot)
+
+    return snapshot
+
+
+def invalidate_user(user_id):
+    user_cache.invalidate(user_id)
+
+
+def write(job):
+    return writer.write(job)
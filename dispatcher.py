@@ -0,0 +1,148 @@
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from telebot.apihelper import ApiTelegramException
+
+from metrics import registry
+
+MESSAGES_PER_SECOND = 25
+WORKERS = 8
+MAX_RETRIES = 3
+PROGRESS_PATH = 'files/notifications.progress'
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    delay = self.paused_until - now
+                else:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    delay = (1 - self.tokens) / self.rate
+
+            time.sleep(delay)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+            self.updated = self.paused_until
+
+
+class Progress:
+    def __init__(self, path, run_id):
+        self.path = path
+        self.run_id = str(run_id)
+        self.done = set()
+        self.lock = threading.Lock()
+
+        if os.path.exists(path):
+            with open(path) as file:
+                lines = file.read().splitlines()
+            if lines and lines[0] == self.run_id:
+                self.done = set(int(line) for line in lines[1:])
+
+        self.file = open(path, 'w')
+        self.file.write(self.run_id + '\n')
+        self.file.writelines('{}\n'.format(telegram_id) for telegram_id in self.done)
+        self.file.flush()
+
+    def __contains__(self, telegram_id):
+        return telegram_id in self.done
+
+    def mark(self, telegram_id):
+        with self.lock:
+            self.done.add(telegram_id)
+            self.file.write('{}\n'.format(telegram_id))
+            self.file.flush()
+
+    def finish(self):
+        self.file.close()
+        os.remove(self.path)
+
+
+class Dispatcher:
+    def __init__(self, bot, workers=WORKERS, rate=MESSAGES_PER_SECOND, max_retries=MAX_RETRIES,
+                 progress_path=PROGRESS_PATH):
+        self.bot = bot
+        self.workers = workers
+        self.bucket = TokenBucket(rate)
+        self.max_retries = max_retries
+        self.progress_path = progress_path
+
+    def send(self, telegram_id, text):
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire()
+            try:
+                self.bot.send_message(telegram_id, text, parse_mode='HTML')
+                return 'sent'
+
+            except ApiTelegramException as e:
+                if e.error_code == 429:
+                    retry_after = e.result_json.get('parameters', {}).get('retry_after', 1)
+                    self.bucket.pause(retry_after)
+                elif e.error_code == 403:
+                    return 'blocked'
+                else:
+                    return 'failed'
+
+            except Exception:
+                if attempt == self.max_retries:
+                    return 'failed'
+                time.sleep(2 ** attempt)
+
+        return 'failed'
+
+    def get_progress_path(self, key):
+        if key is None:
+            return self.progress_path
+
+        return '{}.{}'.format(self.progress_path, re.sub(r'[^\w+-]', '_', key))
+
+    def dispatch(self, run_id, messages, key=None):
+        progress = Progress(self.get_progress_path(key), run_id)
+        stats = {'sent': 0, 'blocked': 0, 'failed': 0, 'skipped': 0}
+        slots = threading.BoundedSemaphore(self.workers * 2)
+        lock = threading.Lock()
+
+        def deliver(telegram_id, text):
+            try:
+                status = self.send(telegram_id, text)
+                if status != 'failed':
+                    progress.mark(telegram_id)
+                with lock:
+                    stats[status] += 1
+                registry.increment('notifications_total', status=status)
+            finally:
+                slots.release()
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='Dispatcher') as executor:
+            for telegram_id, text in messages:
+                if telegram_id in progress:
+                    stats['skipped'] += 1
+                    registry.increment('notifications_total', status='skipped')
+                    continue
+
+                slots.acquire()
+                executor.submit(deliver, telegram_id, text)
+
+        progress.finish()
+
+        return stats
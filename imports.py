@@ -0,0 +1,147 @@
+import json
+import os
+import select
+import subprocess
+import sys
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+
+from planning import store_schedule
+
+IMPORT_WORKERS = 2
+MAX_PENDING_IMPORTS = 64
+IMPORT_TIMEOUT = 30
+PARSER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'workbook.py')
+
+
+class ImportQueueFullError(Exception):
+    def __str__(self):
+        return 'Too many schedules are being imported right now.\nPlease try again in a few minutes'
+
+
+class ParseTimeoutError(Exception):
+    def __str__(self):
+        return 'Reading the schedule took too long.\nPlease check the file and try again'
+
+
+class ParserProcess:
+    def __init__(self):
+        self.process = None
+
+    def start(self):
+        self.process = subprocess.Popen([sys.executable, PARSER_PATH], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def stop(self):
+        if self.process is None:
+            return
+
+        self.process.kill()
+        self.process.wait()
+        for pipe in (self.process.stdin, self.process.stdout):
+            try:
+                pipe.close()
+            except OSError:
+                pass
+        self.process = None
+
+    def restart(self):
+        self.stop()
+        self.start()
+
+    def parse(self, file, timeout):
+        if self.process is None or self.process.poll() is not None:
+            self.restart()
+
+        try:
+            self.process.stdin.write(str(len(file)).encode() + b'\n' + file)
+            self.process.stdin.flush()
+            if not select.select([self.process.stdout], [], [], timeout)[0]:
+                self.restart()
+                raise ParseTimeoutError
+
+            line = self.process.stdout.readline()
+        except OSError:
+            line = b''
+
+        if not line:
+            self.restart()
+            raise Exception('Could not read the schedule')
+
+        response = json.loads(line)
+        if 'error' in response:
+            raise Exception(response['error'])
+
+        return response['subjects'], response['schedule']
+
+
+class ImportQueue:
+    def __init__(self, notify, workers=IMPORT_WORKERS, max_pending=MAX_PENDING_IMPORTS, timeout=IMPORT_TIMEOUT):
+        self.notify = notify
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.pending = OrderedDict()
+        self.running = set()
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ImportThread')
+        self.parsers = Queue()
+        for i in range(workers):
+            self.parsers.put(ParserProcess())
+
+    def submit(self, user_id, chat_id, file):
+        with self.lock:
+            coalesced = user_id in self.pending
+            if not coalesced and len(self.pending) >= self.max_pending:
+                raise ImportQueueFullError
+
+            self.pending[user_id] = (chat_id, file)
+            if user_id in self.running:
+                return coalesced
+
+            self.running.add(user_id)
+
+        self.executor.submit(self.run, user_id)
+
+        return coalesced
+
+    def run(self, user_id):
+        while True:
+            with self.lock:
+                if user_id not in self.pending:
+                    self.running.discard(user_id)
+                    return
+
+                chat_id, file = self.pending.pop(user_id)
+
+            try:
+                self.process(user_id, chat_id, file)
+            except Exception as e:
+                self.send(chat_id, 'Error: {}.'.format(str(e)))
+
+    def process(self, user_id, chat_id, file):
+        self.send(chat_id, 'Reading your schedule...')
+
+        parser = self.parsers.get()
+        try:
+            subjects, schedule = parser.parse(file, self.timeout)
+        finally:
+            self.parsers.put(parser)
+
+        with self.lock:
+            if user_id in self.pending:
+                return
+
+        store_schedule(user_id, subjects, schedule)
+        self.send(chat_id, 'New schedule successfully set.')
+
+    def send(self, chat_id, text):
+        try:
+            self.notify(chat_id, text)
+        except Exception:
+            pass
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+        while not self.parsers.empty():
+            self.parsers.get().stop()
@@ -0,0 +1,370 @@
+import argparse
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import types
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from benchmark import make_form, percentile
+
+TOKEN = '123456:LOADTEST'
+USERS = 1000
+CONCURRENCY = 100
+STEP_TIMEOUT = 30
+POLL_LIMIT = 100
+SCENARIOS = {'week': 4, 'add': 3, 'delete': 2, 'upload': 1}
+SEND_METHODS = ('sendMessage', 'sendDocument', 'editMessageText', 'answerCallbackQuery')
+
+
+class FakeBotAPI:
+    def __init__(self, latency=0.0, rate_limit=0.0, retry_after=1, host='127.0.0.1', port=0):
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.updates = []
+        self.replies = defaultdict(list)
+        self.files = {}
+        self.counts = defaultdict(int)
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.condition = threading.Condition()
+        self.random = random.Random()
+
+        handler = type('BoundFakeBotAPIHandler', (FakeBotAPIHandler,), {'api': self})
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name='FakeBotAPI', daemon=True)
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.server.server_address[:2])
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def push(self, kind, payload):
+        with self.condition:
+            self.updates.append(dict({'update_id': next(self.update_ids)}, **{kind: payload}))
+            self.condition.notify_all()
+
+    def get_updates(self, offset, limit, timeout):
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            self.updates = [update for update in self.updates if update['update_id'] >= offset]
+            while not self.updates and time.monotonic() < deadline:
+                self.condition.wait(deadline - time.monotonic())
+
+            return self.updates[:limit]
+
+    def reply(self, chat_id, method, params):
+        message_id = next(self.message_ids)
+        markup = params.get('reply_markup')
+        with self.condition:
+            self.replies[chat_id].append({'method': method, 'message_id': message_id, 'text': params.get('text', ''),
+                                          'reply_markup': json.loads(markup) if markup else None})
+            self.condition.notify_all()
+
+        return message_id
+
+    def wait_replies(self, chat_id, count, timeout):
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while len(self.replies[chat_id]) < count and time.monotonic() < deadline:
+                self.condition.wait(deadline - time.monotonic())
+
+            return list(self.replies[chat_id])
+
+    def call(self, method, params):
+        with self.condition:
+            self.counts[method] += 1
+
+        if method in SEND_METHODS:
+            if self.latency:
+                time.sleep(self.latency)
+            if self.rate_limit and self.random.random() < self.rate_limit:
+                with self.condition:
+                    self.counts['429'] += 1
+                return 429, {'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after {}'.format(
+                    self.retry_after), 'parameters': {'retry_after': self.retry_after}}
+
+        if method == 'getMe':
+            return 200, {'ok': True, 'result': {'id': 1, 'is_bot': True, 'first_name': 'Load test', 'username': 'bot'}}
+
+        if method == 'getUpdates':
+            updates = self.get_updates(int(params.get('offset', 0)), int(params.get('limit', POLL_LIMIT)),
+                                       float(params.get('timeout', 0)))
+            return 200, {'ok': True, 'result': updates}
+
+        if method == 'getFile':
+            file_id = params.get('file_id', '')
+            return 200, {'ok': True, 'result': {'file_id': file_id, 'file_unique_id': file_id,
+                                                'file_size': len(self.files.get(file_id, b'')), 'file_path': file_id}}
+
+        if method == 'answerCallbackQuery':
+            self.reply(int(params['callback_query_id'].split(':')[0]), method, params)
+            return 200, {'ok': True, 'result': True}
+
+        if method in SEND_METHODS:
+            chat_id = int(params.get('chat_id', 0))
+            message_id = self.reply(chat_id, method, params)
+            return 200, {'ok': True, 'result': {'message_id': message_id, 'date': int(time.time()),
+                                                'chat': {'id': chat_id, 'type': 'private'},
+                                                'text': params.get('text', '')}}
+
+        return 200, {'ok': True, 'result': True}
+
+
+class FakeBotAPIHandler(BaseHTTPRequestHandler):
+    api = None
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        parts = url.path.strip('/').split('/')
+        if parts[0] == 'file':
+            body = self.api.files.get(parts[-1])
+            self.send_body(200 if body is not None else 404, body or b'', 'application/octet-stream')
+            return
+
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        if self.headers.get('Content-Type', '').startswith('application/x-www-form-urlencoded'):
+            params.update({key: values[0] for key, values in parse_qs(body.decode()).items()})
+
+        status, result = self.api.call(parts[-1], params)
+        self.send_body(status, json.dumps(result).encode(), 'application/json')
+
+    do_GET = do_POST
+
+    def send_body(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def get_sender(user_id):
+    return {'id': user_id, 'is_bot': False, 'first_name': 'User {}'.format(user_id)}
+
+
+def text_update(user_id, text):
+    return 'message', {'message_id': 0, 'date': int(time.time()), 'text': text, 'from': get_sender(user_id),
+                       'chat': {'id': user_id, 'type': 'private'}}
+
+
+def document_update(user_id, file_id, size):
+    return 'message', {'message_id': 0, 'date': int(time.time()), 'from': get_sender(user_id),
+                       'chat': {'id': user_id, 'type': 'private'},
+                       'document': {'file_id': file_id, 'file_unique_id': file_id, 'file_name': 'schedule.xlsx',
+                                    'file_size': size}}
+
+
+def callback_update(user_id, reply, data):
+    return 'callback_query', {'id': '{}:{}'.format(user_id, reply['message_id']), 'from': get_sender(user_id),
+                              'chat_instance': str(user_id), 'data': data,
+                              'message': {'message_id': reply['message_id'], 'date': int(time.time()),
+                                          'chat': {'id': user_id, 'type': 'private'}, 'text': reply['text']}}
+
+
+def get_buttons(reply):
+    markup = reply['reply_markup'] or {}
+    rows = markup.get('keyboard') or markup.get('inline_keyboard') or []
+    return [button for row in rows for button in row]
+
+
+def week_scenario(user_id, file_id):
+    yield 'week', text_update(user_id, 'Week'), 1
+
+
+def add_scenario(user_id, file_id):
+    replies = yield 'add', text_update(user_id, 'Add'), 1
+    subjects = [button['text'] for button in get_buttons(replies[-1]) if 'Cancel' not in button['text']]
+    if not subjects:
+        return
+
+    replies = yield 'add_subject', text_update(user_id, random.choice(subjects)), 1
+    replies = yield 'add_date', text_update(user_id, 'Tomorrow'), 1
+    if 'lesson or the end of the day' in replies[-1]['text']:
+        yield 'add_type', text_update(user_id, 'Day'), 1
+
+    yield 'add_description', text_update(user_id, 'Load test exercise {}'.format(random.randint(1, 999))), 2
+
+
+def delete_scenario(user_id, file_id):
+    replies = yield 'delete', text_update(user_id, 'Delete'), 1
+    dates = [button['text'] for button in get_buttons(replies[-1]) if 'Cancel' not in button['text']
+             and 'More' not in button['text']]
+    if not dates:
+        return
+
+    replies = yield 'delete_date', text_update(user_id, dates[0]), 2
+    buttons = [button for button in get_buttons(replies[-1]) if button.get('callback_data') != 'delete:cancel']
+    if buttons:
+        yield 'delete_homework', callback_update(user_id, replies[-1], buttons[0]['callback_data']), 2
+
+
+def upload_scenario(user_id, file_id):
+    yield 'upload', document_update(user_id, file_id, 0), 1
+    yield 'upload_confirm', text_update(user_id, 'Yes'), 3
+
+
+SCENARIO_STEPS = {
+    'week': week_scenario,
+    'add': add_scenario,
+    'delete': delete_scenario,
+    'upload': upload_scenario,
+}
+
+
+class Replay:
+    def __init__(self, api, timeout=STEP_TIMEOUT):
+        self.api = api
+        self.timeout = timeout
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.steps = 0
+        self.lock = threading.Lock()
+
+    def run(self, user_id, scenario, file_id):
+        steps = SCENARIO_STEPS[scenario](user_id, file_id)
+        replies = None
+        try:
+            while True:
+                name, (kind, payload), expected = steps.send(replies)
+                count = len(self.api.replies[user_id]) + expected
+                started = time.perf_counter()
+                self.api.push(kind, payload)
+                replies = self.api.wait_replies(user_id, count, self.timeout)
+                duration = time.perf_counter() - started
+
+                with self.lock:
+                    self.steps += 1
+                    self.latencies[name].append(duration)
+                    if len(replies) < count:
+                        self.errors[name + ':timeout'] += 1
+                    elif any(reply['text'].startswith('Error') for reply in replies[count - expected:]):
+                        self.errors[name + ':error'] += 1
+
+                if len(replies) < count:
+                    return
+
+        except StopIteration:
+            pass
+
+
+def install_token():
+    module = types.ModuleType('my_token')
+    module.TOKEN = TOKEN
+    sys.modules['my_token'] = module
+
+
+def get_handler_latencies():
+    from metrics import registry
+
+    result = {}
+    for labels, histogram in registry.values.get('bot_handler_seconds', {}).items():
+        if histogram.count:
+            result[dict(labels)['handler']] = {'calls': histogram.count,
+                                               'mean_ms': histogram.sum / histogram.count * 1000}
+
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay simulated conversations against a fake Bot API.')
+    parser.add_argument('--users', type=int, default=USERS)
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY)
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help='comma-separated subset of: ' + ', '.join(SCENARIOS))
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every outbound call')
+    parser.add_argument('--rate-limit', type=float, default=0.0, help='share of outbound calls answered with 429')
+    parser.add_argument('--timeout', type=float, default=STEP_TIMEOUT, help='seconds to wait for each reply')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the JSON report to this file instead of stdout')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='loadtest-')
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(directory, 'loadtest.sqlite3')
+    os.environ.pop('DATABASE_ECHO', None)
+
+    api = FakeBotAPI(latency=args.latency, rate_limit=args.rate_limit).start()
+    os.environ['BOT_API_URL'] = api.url
+    install_token()
+
+    import bot
+    from planning import parse_schedule, store_schedule
+
+    rng = random.Random(args.seed)
+    random.seed(args.seed)
+    form = make_form(rng, 8)
+    api.files['schedule'] = form
+    subjects, schedule = parse_schedule(form)
+    for user_id in range(1, args.users + 1):
+        store_schedule(user_id, subjects, schedule)
+
+    names = args.scenarios.split(',')
+    weights = [SCENARIOS[name] for name in names]
+    plan = [(user_id, scenario) for user_id in range(1, args.users + 1)
+            for scenario in rng.choices(names, weights, k=len(names))]
+
+    polling = threading.Thread(target=bot.bot.polling, kwargs={'none_stop': True, 'interval': 0, 'timeout': 1},
+                               name='BotThread', daemon=True)
+    polling.start()
+
+    replay = Replay(api, args.timeout)
+    per_user = defaultdict(list)
+    for user_id, scenario in plan:
+        per_user[user_id].append(scenario)
+
+    def run_user(user_id):
+        for scenario in per_user[user_id]:
+            replay.run(user_id, scenario, 'schedule')
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(run_user, per_user))
+    elapsed = time.perf_counter() - started
+
+    bot.bot.stop_polling()
+    bot.import_queue.shutdown()
+    api.stop()
+
+    errors = sum(replay.errors.values())
+    report = {
+        'users': args.users, 'concurrency': args.concurrency, 'latency': args.latency, 'rate_limit': args.rate_limit,
+        'elapsed_s': elapsed, 'steps': replay.steps, 'steps_per_s': replay.steps / elapsed,
+        'error_rate': errors / replay.steps if replay.steps else 0.0, 'errors': dict(replay.errors),
+        'api_calls': dict(api.counts),
+        'steps_latency': {name: {'calls': len(samples), 'p50_ms': percentile(samples, 50) * 1000,
+                                 'p99_ms': percentile(samples, 99) * 1000}
+                          for name, samples in sorted(replay.latencies.items())},
+        'handlers': get_handler_latencies(),
+    }
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,329 @@
+import contextvars
+import functools
+import inspect
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from sqlalchemy import event
+
+from db import engine
+
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 9108))
+SLOW_CALL_THRESHOLD = float(os.environ.get('SLOW_CALL_THRESHOLD', 0)) or None
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SEND_METHODS = ('send_message', 'send_document', 'edit_message_text', 'answer_callback_query', 'get_file',
+                'download_file')
+
+METRICS = {
+    'bot_handler_seconds': ('histogram', 'Time spent in a bot handler.'),
+    'bot_handler_sql_statements_total': ('counter', 'SQL statements executed by a bot handler.'),
+    'bot_handler_errors_total': ('counter', 'Exceptions raised by a bot handler.'),
+    'planning_call_seconds': ('histogram', 'Time spent in a planning function.'),
+    'planning_call_sql_statements_total': ('counter', 'SQL statements executed by a planning function.'),
+    'planning_call_errors_total': ('counter', 'Exceptions raised by a planning function.'),
+    'telegram_request_seconds': ('histogram', 'Latency of outbound Bot API requests.'),
+    'telegram_request_errors_total': ('counter', 'Outbound Bot API requests that failed.'),
+    'notifications_total': ('counter', 'Notifications handled by the dispatcher, by outcome.'),
+    'sql_statements_total': ('counter', 'SQL statements executed by the process.'),
+}
+
+logger = logging.getLogger('metrics')
+scopes = contextvars.ContextVar('metrics_scopes', default=())
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels):
+        lines = []
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            lines.append('{}_bucket{} {}'.format(name, format_labels(labels + (('le', '{:g}'.format(bound)),)), total))
+
+        lines.append('{}_bucket{} {}'.format(name, format_labels(labels + (('le', '+Inf'),)), self.count))
+        lines.append('{}_sum{} {}'.format(name, format_labels(labels), format_value(self.sum)))
+        lines.append('{}_count{} {}'.format(name, format_labels(labels), self.count))
+        return lines
+
+
+def format_value(value):
+    if isinstance(value, int):
+        return str(value)
+
+    return repr(float(value))
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+
+    return '{' + ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for key, value in labels) + '}'
+
+
+class Registry:
+    def __init__(self):
+        self.values = {}
+        self.gauges = {}
+        self.lock = threading.Lock()
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.values.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram()
+            series[key].observe(value)
+
+    def increment(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.values.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def gauge(self, name, callback, help=''):
+        self.gauges[name] = (callback, help)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, series in sorted(self.values.items()):
+                kind, help = METRICS.get(name, ('untyped', ''))
+                lines.append('# HELP {} {}'.format(name, help))
+                lines.append('# TYPE {} {}'.format(name, kind))
+                for labels, value in sorted(series.items()):
+                    if isinstance(value, Histogram):
+                        lines.extend(value.render(name, labels))
+                    else:
+                        lines.append('{}{} {}'.format(name, format_labels(labels), format_value(value)))
+
+        for name, (callback, help) in sorted(self.gauges.items()):
+            try:
+                value = callback()
+            except Exception:
+                continue
+
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} gauge'.format(name))
+            lines.append('{} {}'.format(name, format_value(value)))
+
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+slow_call_threshold = SLOW_CALL_THRESHOLD
+
+
+def set_slow_call_threshold(seconds):
+    global slow_call_threshold
+    slow_call_threshold = seconds or None
+
+
+class Scope:
+    __slots__ = ('statements', 'queries')
+
+    def __init__(self, queries):
+        self.statements = 0
+        self.queries = [] if queries else None
+
+
+@event.listens_for(engine, 'before_cursor_execute')
+def count_statement(connection, cursor, statement, parameters, context, executemany):
+    registry.increment('sql_statements_total')
+    for scope in scopes.get():
+        scope.statements += 1
+        if scope.queries is not None:
+            scope.queries.append(statement)
+
+
+def start_scope(log_queries=False):
+    scope = Scope(log_queries)
+    return scope, scopes.set(scopes.get() + (scope,))
+
+
+def finish_scope(kind, label, name, scope, token, started, failed):
+    duration = time.perf_counter() - started
+    scopes.reset(token)
+
+    registry.observe(kind + '_seconds', duration, **{label: name})
+    registry.increment(kind + '_sql_statements_total', scope.statements, **{label: name})
+    if failed:
+        registry.increment(kind + '_errors_total', **{label: name})
+
+    if scope.queries is not None and slow_call_threshold and duration >= slow_call_threshold:
+        logger.warning('Slow %s %s: %.3f s, %d SQL statements:\n%s', label, name, duration, scope.statements,
+                       '\n'.join(scope.queries))
+
+
+def instrument(function, kind, label, log_queries=False):
+    name = function.__name__
+
+    if inspect.iscoroutinefunction(function):
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            scope, token = start_scope(log_queries and slow_call_threshold)
+            started = time.perf_counter()
+            failed = True
+            try:
+                result = await function(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                finish_scope(kind, label, name, scope, token, started, failed)
+
+    elif inspect.isgeneratorfunction(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            scope = Scope(False)
+            duration = 0.0
+            failed = True
+            iterator = function(*args, **kwargs)
+            try:
+                while True:
+                    token = scopes.set(scopes.get() + (scope,))
+                    started = time.perf_counter()
+                    try:
+                        item = next(iterator)
+                    except StopIteration:
+                        failed = False
+                        return
+                    finally:
+                        duration += time.perf_counter() - started
+                        scopes.reset(token)
+
+                    try:
+                        yield item
+                    except GeneratorExit:
+                        failed = False
+                        raise
+
+            finally:
+                iterator.close()
+                registry.observe(kind + '_seconds', duration, **{label: name})
+                registry.increment(kind + '_sql_statements_total', scope.statements, **{label: name})
+                if failed:
+                    registry.increment(kind + '_errors_total', **{label: name})
+
+    else:
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            scope, token = start_scope(log_queries and slow_call_threshold)
+            started = time.perf_counter()
+            failed = True
+            try:
+                result = function(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                finish_scope(kind, label, name, scope, token, started, failed)
+
+    return wrapper
+
+
+def timed(function):
+    return instrument(function, 'planning_call', 'function')
+
+
+def instrument_handler(function):
+    return instrument(function, 'bot_handler', 'handler', log_queries=True)
+
+
+def instrument_request(function, method):
+    if inspect.iscoroutinefunction(function):
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await function(*args, **kwargs)
+            except Exception:
+                registry.increment('telegram_request_errors_total', method=method)
+                raise
+            finally:
+                registry.observe('telegram_request_seconds', time.perf_counter() - started, method=method)
+
+    else:
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            except Exception:
+                registry.increment('telegram_request_errors_total', method=method)
+                raise
+            finally:
+                registry.observe('telegram_request_seconds', time.perf_counter() - started, method=method)
+
+    return wrapper
+
+
+def instrument_bot(bot):
+    for handlers in (bot.message_handlers, bot.callback_query_handlers):
+        for handler in handlers:
+            handler['function'] = instrument_handler(handler['function'])
+
+    for method in SEND_METHODS:
+        setattr(bot, method, instrument_request(getattr(bot, method), method))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/metrics':
+            body = registry.render().encode()
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+        elif url.path == '/slow':
+            query = parse_qs(url.query)
+            if 'threshold' in query:
+                try:
+                    set_slow_call_threshold(float(query['threshold'][0]))
+                except ValueError:
+                    self.send_response(400)
+                    self.end_headers()
+                    return
+
+            body = 'Slow call threshold: {}\n'.format(slow_call_threshold or 'off').encode()
+            content_type = 'text/plain; charset=utf-8'
+
+        else:
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(host=METRICS_HOST, port=METRICS_PORT):
+    if not port:
+        return None
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name='MetricsThread', daemon=True)
+    thread.start()
+    return server
@@ -0,0 +1,99 @@
+import json
+
+from sqlalchemy import text
+
+from timetable import Timetable
+
+MIGRATIONS = []
+SCHEMA = []
+SEARCH_SUBJECT = '(SELECT name FROM subject WHERE user_id = NEW.user_id ORDER BY id LIMIT 1 OFFSET NEW.subject)'
+
+
+def migration(function):
+    MIGRATIONS.append(function)
+    return function
+
+
+def schema(function):
+    SCHEMA.append(function)
+    return function
+
+
+@schema
+def create_homework_search(connection):
+    connection.execute(text("CREATE VIRTUAL TABLE IF NOT EXISTS homework_search USING fts5("
+                            "owner, subject, description, "
+                            "tokenize = 'porter unicode61 remove_diacritics 2', prefix = '2 3')"))
+    connection.execute(text('CREATE TRIGGER IF NOT EXISTS homework_search_insert AFTER INSERT ON homework BEGIN '
+                            'INSERT INTO homework_search (rowid, owner, subject, description) '
+                            'VALUES (NEW.id, NEW.user_id, {}, NEW.description); END'.format(SEARCH_SUBJECT)))
+    connection.execute(text('CREATE TRIGGER IF NOT EXISTS homework_search_delete AFTER DELETE ON homework BEGIN '
+                            'DELETE FROM homework_search WHERE rowid = OLD.id; END'))
+    connection.execute(text('CREATE TRIGGER IF NOT EXISTS homework_search_update '
+                            'AFTER UPDATE OF subject, description, user_id ON homework BEGIN '
+                            'UPDATE homework_search SET owner = NEW.user_id, subject = {}, '
+                            'description = NEW.description WHERE rowid = NEW.id; END'.format(SEARCH_SUBJECT)))
+
+
+@migration
+def add_homework_indexes(connection):
+    connection.execute(text('CREATE INDEX IF NOT EXISTS ix_homework_user_date '
+                            'ON homework (user_id, date, for_lesson, subject)'))
+    connection.execute(text('CREATE INDEX IF NOT EXISTS ix_homework_date ON homework (date, for_lesson)'))
+    connection.execute(text('CREATE INDEX IF NOT EXISTS ix_subject_user ON subject (user_id, id)'))
+
+
+@migration
+def add_notification_time(connection):
+    connection.execute(text('ALTER TABLE settings ADD COLUMN notification_time INTEGER NOT NULL DEFAULT 1080'))
+    connection.execute(text('CREATE INDEX IF NOT EXISTS ix_settings_notification '
+                            'ON settings (timezone, notification_time)'))
+
+
+@migration
+def add_homework_search(connection):
+    create_homework_search(connection)
+    connection.execute(text('INSERT INTO homework_search (rowid, owner, subject, description) '
+                            'SELECT homework.id, homework.user_id, positions.name, homework.description FROM homework '
+                            'JOIN (SELECT user_id, name, row_number() OVER (PARTITION BY user_id ORDER BY id) - 1 '
+                            'AS position FROM subject) AS positions '
+                            'ON positions.user_id = homework.user_id AND positions.position = homework.subject'))
+
+
+@migration
+def store_timetables(connection):
+    connection.execute(text('ALTER TABLE user ADD COLUMN timetable BLOB'))
+
+    timetables = []
+    for user_id, schedule in connection.execute(text('SELECT id, schedule FROM user WHERE schedule IS NOT NULL')):
+        schedule = json.loads(schedule)
+        if isinstance(schedule, str):  # set_schedule used to store json.dumps() output in the JSON column
+            schedule = json.loads(schedule)
+        if schedule:
+            timetables.append({'id': user_id, 'timetable': Timetable.from_schedule(schedule).to_bytes()})
+
+    if timetables:
+        connection.execute(text('UPDATE user SET timetable = :timetable WHERE id = :id'), timetables)
+    connection.execute(text('UPDATE user SET schedule = NULL'))
+
+
+def get_version(connection):
+    return connection.execute(text('PRAGMA user_version')).scalar()
+
+
+def set_version(connection, version):
+    connection.execute(text('PRAGMA user_version = {:d}'.format(version)))
+
+
+def migrate(engine, fresh=False):
+    with engine.begin() as connection:
+        if fresh:
+            for function in SCHEMA:
+                function(connection)
+            set_version(connection, len(MIGRATIONS))
+            return
+
+        version = get_version(connection)
+        for number, function in enumerate(MIGRATIONS[version:], start=version + 1):
+            function(connection)
+            set_version(connection, number)
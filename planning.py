@@ -1,15 +1,27 @@
 import datetime
-import json
-from itertools import islice
+import re
+from itertools import groupby
 
 import pytz
-from pandas import ExcelFile
+from sqlalchemy import and_, func, or_, text
 
-from db import MAX_LESSONS, User, Subject, Homework, Session, get_user
+from cache import VersionedCache
+from db import MAX_LESSONS, User, Subject, Settings, Homework, Session, get_user, get_snapshot, invalidate_user, \
+    write
+from metrics import timed
+from timetable import Timetable
+from workbook import parse_schedule as parse_workbook
 
 WEEK_DAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
 SHORT_WEEK_DAYS = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
 TIMEZONE = pytz.timezone('Europe/Moscow')
+SCHEDULE_CACHE_SIZE = 8192
+SEARCH_PAGE_SIZE = 10
+MAX_SEARCH_TERMS = 8
+MAX_RESULT_LENGTH = 300
+SEARCH_WEIGHTS = (0.0, 2.0, 1.0)
+
+schedule_cache = VersionedCache(maxsize=SCHEDULE_CACHE_SIZE)
 
 
 class ScheduleNotFoundError(Exception):
@@ -17,192 +29,212 @@ class ScheduleNotFoundError(Exception):
         return 'Schedule not found.\nPlease set your schedule before requesting it'
 
 
-def set_schedule(user_id, file):
-    file = ExcelFile(file)
-    df = file.parse(file.sheet_names[0])
+class EmptySearchError(Exception):
+    def __str__(self):
+        return 'Nothing to search for.\nPlease type some words after the command, e.g. /find essay'
 
-    data = df[df.columns[1:4]].to_dict('records')
 
+def format_date(ordinal_date):
+    date = datetime.date.fromordinal(ordinal_date)
+    return '{}.{} ({})'.format(str(date.day).zfill(2), str(date.month).zfill(2), SHORT_WEEK_DAYS[date.weekday()])
+
+
+parse_schedule = timed(parse_workbook)
+
+
+@timed
+def store_schedule(user_id, subjects, schedule):
     session, user = get_user(user_id)
 
     user.subjects.clear()
+    for name, teacher, room in subjects:
+        user.subjects.append(Subject(name=name, teacher=teacher, room=room))
 
-    for row in data:
-        if type(row['Subject']) != float:
-            teacher = row['Teacher'] if type(row['Teacher']) != float else None
-            room = row['Room'] if type(row['Room']) != float else None
-            user.subjects.append(Subject(name=row['Subject'], teacher=teacher, room=room))
-
-    schedule = [[[], [], [], [], [], []],
-                [[], [], [], [], [], []]]
-
-    day_index = 0
-    for label, values in islice(df.items(), 6, 12):
-        for subject in values[1:]:
-            if type(subject) == float:
-                schedule[0][day_index].append(-1)
-            else:
-                schedule[0][day_index].append(subject)
-            if len(schedule[0][day_index]) >= MAX_LESSONS:
-                break
-        day_index += 1
-
-    day_index = 0
-    for label, values in islice(df.items(), 14, 20):
-        for subject in values[1:]:
-            if type(subject) == float:
-                schedule[1][day_index].append(-1)
-            else:
-                schedule[1][day_index].append(subject)
-            if len(schedule[1][day_index]) >= MAX_LESSONS:
-                break
-        day_index += 1
-
-    user.schedule = json.dumps(schedule)
+    user.timetable = Timetable.from_schedule(schedule).to_bytes()
     user.homework.clear()
 
     session.commit()
     session.close()
 
+    invalidate_user(user_id)
+    schedule_cache.bump(user_id)
 
-def get_schedule(user_id, ordinal_date):
-    session, user = get_user(user_id)
-    if not user.schedule or not user.subjects:
-        session.close()
-        raise ScheduleNotFoundError
 
-    schedule = json.loads(user.schedule)
+@timed
+def set_schedule(user_id, file):
+    subjects, schedule = parse_schedule(file)
+    store_schedule(user_id, subjects, schedule)
+
+
+@timed
+def group_homework(homework):
+    grouped = {}
+    for h in homework:
+        grouped.setdefault((h.date, h.for_lesson), {}).setdefault(h.subject, []).append(h.description)
+
+    return grouped
+
+
+@timed
+def render_day(ordinal_date, timetable, subjects, grouped):
+    lesson_homework = grouped.get((ordinal_date, True), {})
+    day_homework = grouped.get((ordinal_date, False), {})
 
     date = datetime.date.fromordinal(ordinal_date)
     week = date.isocalendar()[1] % 2
     week_day = date.weekday()
 
-    result = '<i>{} ({}.{}):</i>\n\n'.format(WEEK_DAYS[week_day], str(date.day).zfill(2), str(date.month).zfill(2))
+    result = ['<i>{} ({}.{}):</i>\n\n'.format(WEEK_DAYS[week_day], str(date.day).zfill(2), str(date.month).zfill(2))]
     if week_day == 6:
-        result += 'No lessons.\n\n'
+        result.append('No lessons.\n\n')
     else:
-        day_schedule = schedule[week][week_day]
-        if day_schedule == [-1] * MAX_LESSONS:
-            result += 'No lessons.\n\n'
+        day_schedule = timetable.day(week, week_day)
+        if all(subject_index == -1 for subject_index in day_schedule):
+            result.append('No lessons.\n\n')
         else:
             for index in range(MAX_LESSONS):
                 subject_index = day_schedule[index]
 
                 if subject_index != -1:
-                    subject = user.subjects[subject_index]
-                    result += '{}:   {}\n'.format(index + 1, subject.name)
+                    subject = subjects[subject_index]
+                    result.append('{}:   {}\n'.format(index + 1, subject.name))
 
                     if subject.teacher is not None:
-                        result += subject.teacher + '\n'
+                        result.append(subject.teacher + '\n')
 
                     if subject.room is not None:
-                        result += subject.room + '\n'
+                        result.append(subject.room + '\n')
 
-                    homework = session.query(Homework).filter_by(date=ordinal_date, subject=subject_index,
-                                                                 for_lesson=True, user_id=user.id).all()
-                    for h in homework:
-                        result += '❗<b>{}</b>\n'.format(h.description)
+                    for description in lesson_homework.get(subject_index, ()):
+                        result.append('❗<b>{}</b>\n'.format(description))
 
-                    result += '\n'
+                    result.append('\n')
 
-    homework = session.query(Homework).filter_by(date=ordinal_date, for_lesson=False, user_id=user.id) \
-        .order_by(Homework.subject).all()
-    subject_index = None
-    for h in homework:
-        if subject_index != h.subject:
-            subject_index = h.subject
-            subject_name = user.subjects[subject_index].name
-            result += '\n' + subject_name + '\n'
-        result += '❗<b>{}</b>\n'.format(h.description)
+    for subject_index in sorted(day_homework):
+        result.append('\n' + subjects[subject_index].name + '\n')
+        for description in day_homework[subject_index]:
+            result.append('❗<b>{}</b>\n'.format(description))
 
-    session.close()
+    return ''.join(result)
 
-    return result
 
+@timed
+def get_schedule(user_id, ordinal_date):
+    result = schedule_cache.get(user_id, ordinal_date)
+    if result is not None:
+        return result
 
-def in_schedule(user_id, ordinal_date, subject_index):
-    session, user = get_user(user_id)
-    if not user.schedule:
-        session.close()
+    version = schedule_cache.version(user_id)
+    user = get_snapshot(user_id)
+    if not user.schedule or not user.subjects:
         raise ScheduleNotFoundError
 
-    date = datetime.date.fromordinal(ordinal_date)
-    week = date.isocalendar()[1] % 2
-    week_day = date.weekday()
-    if week_day == 6:
-        return False
+    session = Session()
+    homework = session.query(Homework).filter_by(date=ordinal_date, user_id=user.id) \
+        .order_by(Homework.subject, Homework.id).all()
+    result = render_day(ordinal_date, user.schedule, user.subjects, group_homework(homework))
 
-    schedule = json.loads(user.schedule)
     session.close()
 
-    return subject_index in schedule[week][week_day]
+    schedule_cache.set(user_id, ordinal_date, result, version)
 
+    return result
 
-def get_subjects(user_id):
-    session, user = get_user(user_id)
-    if not user.subjects:
-        session.close()
+
+@timed
+def get_schedule_range(user_id, start, end):
+    return get_schedules(user_id, list(range(start, end + 1)))
+
+
+@timed
+def get_schedules(user_id, ordinal_dates):
+    cached = [schedule_cache.get(user_id, ordinal_date) for ordinal_date in ordinal_dates]
+    missing = [ordinal_date for ordinal_date, text in zip(ordinal_dates, cached) if text is None]
+    if not missing:
+        return cached
+
+    version = schedule_cache.version(user_id)
+    user = get_snapshot(user_id)
+    if not user.schedule or not user.subjects:
         raise ScheduleNotFoundError
 
-    subjects = [s.name for s in user.subjects]
+    session = Session()
+    homework = session.query(Homework).filter(Homework.user_id == user.id, Homework.date.in_(missing)) \
+        .order_by(Homework.date, Homework.subject, Homework.id).all()
+    grouped = group_homework(homework)
     session.close()
 
-    return subjects
+    rendered = {}
+    for ordinal_date in missing:
+        rendered[ordinal_date] = render_day(ordinal_date, user.schedule, user.subjects, grouped)
+        schedule_cache.set(user_id, ordinal_date, rendered[ordinal_date], version)
 
+    return [rendered.get(ordinal_date, text) for ordinal_date, text in zip(ordinal_dates, cached)]
 
-def add_homework(user_id, subject_index, date, for_lesson, description):
-    session, user = get_user(user_id)
+
+@timed
+def in_schedule(user_id, ordinal_date, subject_index):
+    user = get_snapshot(user_id)
     if not user.schedule:
-        session.close()
         raise ScheduleNotFoundError
 
-    if not date:
-        schedule = json.loads(user.schedule)
+    return user.schedule.has_lesson(ordinal_date, subject_index)
 
-        date = datetime.datetime.now(TIMEZONE).date().toordinal() + 1
-        week = datetime.date.fromordinal(date).isocalendar()[1] % 2
-        week_day = datetime.date.fromordinal(date).weekday()
-        for i in range(14):
-            if week_day == 6:
-                date += 1
-                week = (week + 1) % 2
-                week_day = 0
-                continue
 
-            day_schedule = schedule[week][week_day]
-            if subject_index in day_schedule:
-                break
+@timed
+def get_subjects(user_id):
+    user = get_snapshot(user_id)
+    if not user.subjects:
+        raise ScheduleNotFoundError
 
-            date += 1
-            week_day += 1
+    return [s.name for s in user.subjects]
 
-    user.homework.append(Homework(date=date, subject=subject_index, for_lesson=for_lesson, description=description))
 
-    session.commit()
-    session.close()
+@timed
+def get_next_lesson(timetable, subject_index):
+    start = datetime.datetime.now(TIMEZONE).date().toordinal() + 1
+    date = timetable.next_lesson(subject_index, start)
 
-    return date
+    return date if date is not None else start + 14
 
 
-def get_dates(user_id, ordinal=False):
-    session, user = get_user(user_id)
+@timed
+def get_next_lessons(user_id, subject_index, start, count):
+    user = get_snapshot(user_id)
+    if not user.schedule:
+        raise ScheduleNotFoundError
 
-    if not user.homework:
-        session.close()
-        return None
+    return user.schedule.next_lessons(subject_index, start, count)
 
-    today = datetime.datetime.now(TIMEZONE).date().toordinal()
 
-    ordinal_dates = [h.date for h in user.homework if h.date >= today]
-    session.close()
+@timed
+def get_next_lesson_date(user_id, subject_index):
+    user = get_snapshot(user_id)
+    if not user.schedule:
+        raise ScheduleNotFoundError
 
-    if not ordinal_dates:
-        return None
+    return get_next_lesson(user.schedule, subject_index)
 
-    ordinal_dates = sorted(list(set(ordinal_dates)))
 
-    if ordinal:
-        return ordinal_dates
+@timed
+def add_homework(user_id, subject_index, date, for_lesson, description):
+    user = get_snapshot(user_id)
+    if not user.schedule:
+        raise ScheduleNotFoundError
+
+    if not date:
+        date = get_next_lesson(user.schedule, subject_index)
+
+    homework = Homework(date=date, subject=subject_index, for_lesson=for_lesson, description=description,
+                        user_id=user.id)
+    write(lambda session: session.add(homework))
+    schedule_cache.bump(user_id)
+
+    return date
+
+
+def get_date_labels(ordinal_dates):
+    today = datetime.datetime.now(TIMEZONE).date().toordinal()
 
     dates = []
     for ordinal_date in ordinal_dates:
@@ -211,21 +243,50 @@ def get_dates(user_id, ordinal=False):
         elif ordinal_date == today + 1:
             dates.append('Tomorrow')
         else:
-            date = datetime.date.fromordinal(ordinal_date)
-            dates.append('{}.{} ({})'.format(str(date.day).zfill(2), str(date.month).zfill(2),
-                                             SHORT_WEEK_DAYS[date.weekday()]))
+            dates.append(format_date(ordinal_date))
 
     return dates
 
 
+@timed
+def get_dates(user_id, ordinal=False, after=None, before=None, limit=None):
+    user = get_snapshot(user_id)
+    start = datetime.datetime.now(TIMEZONE).date().toordinal()
+    if after is not None:
+        start = max(start, after + 1)
+
+    session = Session()
+    query = session.query(Homework.date).filter(Homework.user_id == user.id, Homework.date >= start).distinct()
+    if before is not None:
+        query = query.filter(Homework.date < before).order_by(Homework.date.desc())
+    else:
+        query = query.order_by(Homework.date)
+    if limit:
+        query = query.limit(limit)
+    ordinal_dates = [row.date for row in query]
+    session.close()
+
+    if before is not None:
+        ordinal_dates.reverse()
+
+    if not ordinal_dates:
+        return None
+
+    if ordinal:
+        return ordinal_dates
+
+    return get_date_labels(ordinal_dates)
+
+
+@timed
 def get_homework(user_id, ordinal_date):
-    try:
-        subjects = get_subjects(user_id)
-    except ScheduleNotFoundError:
+    user = get_snapshot(user_id)
+    if not user.subjects:
         return None
 
-    session, user = get_user(user_id)
-    homework = session.query(Homework).filter_by(date=ordinal_date, user_id=user.id).order_by(Homework.subject).all()
+    session = Session()
+    homework = session.query(Homework).filter_by(date=ordinal_date, user_id=user.id) \
+        .order_by(Homework.subject, Homework.id).all()
     session.close()
 
     if not homework:
@@ -233,86 +294,149 @@ def get_homework(user_id, ordinal_date):
 
     result = []
     for h in homework:
-        result.append('{} ({}):   {}'.format(subjects[h.subject], 'lesson' if h.for_lesson else 'day', h.description))
+        result.append((h.id, '{} ({}):   {}'.format(user.subjects[h.subject].name, 'lesson' if h.for_lesson else 'day',
+                                                    h.description)))
 
     return result
 
 
-def delete_homework(user_id, ordinal_date, homework_str):
-    subjects = get_subjects(user_id)
+def get_search_terms(query):
+    return re.findall(r'\w+', query.lower())[:MAX_SEARCH_TERMS]
 
-    homework_str = homework_str.split('):   ')
-    description = homework_str[-1]
-    homework_type = homework_str[0].split('(')[-1]
-    for_lesson = True if homework_type == 'lesson' else False
-    subject = homework_str[0].split(' ({}'.format(homework_type))[0]
-    subject_index = subjects.index(subject)
 
-    session, user = get_user(user_id)
-    row_to_delete = session.query(Homework).filter_by(date=ordinal_date, subject=subject_index, for_lesson=for_lesson,
-                                                      description=description, user_id=user.id).first()
-    if row_to_delete:
-        session.delete(row_to_delete)
+def get_match_expression(user_id, terms):
+    return 'owner : "{}" AND {{subject description}} : ({})'.format(
+        user_id, ' '.join('"{}"*'.format(term) for term in terms))
 
-    session.commit()
+
+@timed
+def search_homework(user_id, terms, offset=0, limit=SEARCH_PAGE_SIZE):
+    if not terms:
+        raise EmptySearchError
+
+    user = get_snapshot(user_id)
+    if not user.subjects:
+        return 0, []
+
+    parameters = {'match': get_match_expression(user.id, terms), 'offset': offset, 'limit': limit}
+    session = Session()
+    total = session.execute(text('SELECT count(*) FROM homework_search WHERE homework_search MATCH :match'),
+                            parameters).scalar()
+    rows = []
+    if total > offset:
+        rows = session.execute(text('SELECT homework.date, homework.subject, homework.for_lesson, homework.description '
+                                    'FROM homework_search JOIN homework ON homework.id = homework_search.rowid '
+                                    'WHERE homework_search MATCH :match '
+                                    'ORDER BY bm25(homework_search, {:g}, {:g}, {:g}), homework.date, homework.id '
+                                    'LIMIT :limit OFFSET :offset'.format(*SEARCH_WEIGHTS)), parameters).fetchall()
     session.close()
 
-    if not row_to_delete:
+    result = []
+    for h in rows:
+        description = h.description if len(h.description) <= MAX_RESULT_LENGTH else \
+            h.description[:MAX_RESULT_LENGTH - 1] + '…'
+        result.append((h.date, '{} ({}):   {}'.format(user.subjects[h.subject].name,
+                                                     'lesson' if h.for_lesson else 'day', description)))
+
+    return total, result
+
+
+@timed
+def delete_homework(user_id, homework_ids):
+    user = get_snapshot(user_id)
+
+    deleted = write(lambda session: session.query(Homework)
+                    .filter(Homework.id.in_(homework_ids), Homework.user_id == user.id)
+                    .delete(synchronize_session=False))
+    schedule_cache.bump(user_id)
+    if not deleted:
         raise Exception('Could not find the homework to delete')
 
-    return ordinal_date
+    return deleted
 
 
+@timed
 def delete_past_homework():
     today = datetime.datetime.now(TIMEZONE).date().toordinal()
 
-    session = Session()
-    session.query(Homework).filter(Homework.date < today - 1).delete()
+    write(lambda session: session.query(Homework).filter(Homework.date < today - 1).delete())
+    schedule_cache.bump()
 
-    session.commit()
+
+@timed
+def get_notification_settings(user_id):
+    user = get_snapshot(user_id)
+
+    session = Session()
+    settings = session.query(Settings.timezone, Settings.notification_time).filter(Settings.user_id == user.id).one()
     session.close()
 
+    return settings.timezone, settings.notification_time
 
-def get_notifications():
-    today = datetime.datetime.now(TIMEZONE).date().toordinal()
 
-    session = Session()
-    users = [(user.id, user.telegram_id) for user in session.query(User).all()]
+@timed
+def set_notification_settings(user_id, timezone=None, notification_time=None):
+    user = get_snapshot(user_id)
 
-    result = []
-    for user_id, telegram_id in users:
-        try:
-            subjects = get_subjects(telegram_id)
-        except ScheduleNotFoundError:
-            continue
-
-        text = ''
-        today_homework = session.query(Homework).filter_by(user_id=user_id, date=today, for_lesson=False) \
-            .order_by(Homework.subject).all()
-        if today_homework:
-            text += '<i>Today (until the end of the day):</i>\n'
-            subject = None
-            for h in today_homework:
-                if subject != h.subject:
-                    subject = h.subject
-                    text += '\n' + subjects[subject] + '\n'
-                text += '❗<b>{}</b>\n'.format(h.description)
-            text += '\n\n'
-
-        tomorrow_homework = session.query(Homework).filter_by(user_id=user_id, date=today + 1, for_lesson=True) \
-            .order_by(Homework.subject).all()
-        if tomorrow_homework:
-            text += '<i>Tomorrow (only for the lessons):</i>\n'
-            subject = None
-            for h in tomorrow_homework:
-                if subject != h.subject:
-                    subject = h.subject
-                    text += '\n' + subjects[subject] + '\n'
-                text += '❗<b>{}</b>\n'.format(h.description)
-
-        if text != '':
-            result.append((telegram_id, text))
+    values = {}
+    if timezone is not None:
+        values[Settings.timezone] = timezone
+    if notification_time is not None:
+        values[Settings.notification_time] = notification_time
+
+    if values:
+        write(lambda session: session.query(Settings).filter(Settings.user_id == user.id).update(values))
 
+
+@timed
+def get_notification_buckets():
+    session = Session()
+    buckets = session.query(Settings.timezone, Settings.notification_time).distinct().all()
     session.close()
 
-    return result
+    return [(timezone, notification_time) for timezone, notification_time in buckets]
+
+
+@timed
+def get_notifications(bucket=None, today=None):
+    if today is None:
+        today = datetime.datetime.now(TIMEZONE).date().toordinal()
+
+    session = Session()
+    positions = session.query(Subject.user_id.label('user_id'), Subject.name.label('name'),
+                              (func.row_number().over(partition_by=Subject.user_id, order_by=Subject.id) - 1)
+                              .label('position')).subquery()
+    rows = session.query(User.telegram_id, Homework.for_lesson, Homework.subject, positions.c.name,
+                         Homework.description) \
+        .join(Homework, Homework.user_id == User.id) \
+        .join(positions, and_(positions.c.user_id == Homework.user_id, positions.c.position == Homework.subject)) \
+        .filter(or_(and_(Homework.date == today, Homework.for_lesson.is_(False)),
+                    and_(Homework.date == today + 1, Homework.for_lesson.is_(True))))
+    if bucket is not None:
+        rows = rows.join(Settings, Settings.user_id == User.id) \
+            .filter(Settings.timezone == bucket[0], Settings.notification_time == bucket[1])
+    rows = rows.order_by(User.id, Homework.for_lesson, Homework.subject, Homework.id).yield_per(1000)
+
+    try:
+        for telegram_id, user_rows in groupby(rows, key=lambda row: row.telegram_id):
+            text = []
+            for for_lesson, homework in groupby(user_rows, key=lambda row: row.for_lesson):
+                if for_lesson:
+                    text.append('<i>Tomorrow (only for the lessons):</i>\n')
+                else:
+                    text.append('<i>Today (until the end of the day):</i>\n')
+
+                subject = None
+                for h in homework:
+                    if subject != h.subject:
+                        subject = h.subject
+                        text.append('\n' + h.name + '\n')
+                    text.append('❗<b>{}</b>\n'.format(h.description))
+
+                if not for_lesson:
+                    text.append('\n\n')
+
+            yield telegram_id, ''.join(text)
+
+    finally:
+        session.close()
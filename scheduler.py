@@ -0,0 +1,103 @@
+import datetime
+import heapq
+import json
+import os
+import time
+
+from planning import get_notification_buckets, get_notifications
+
+RUNS_PATH = 'files/notifications.runs'
+TICK = 30
+REFRESH_INTERVAL = 5 * 60
+CATCH_UP = 4 * 60 * 60
+RETRY_DELAY = 5 * 60
+
+
+def get_bucket_key(bucket):
+    timezone, notification_time = bucket
+    return 'UTC{:+g}@{:02d}:{:02d}'.format(timezone, *divmod(notification_time, 60))
+
+
+def get_local_date(timestamp, timezone):
+    return datetime.datetime.utcfromtimestamp(timestamp + timezone * 60 * 60).date().toordinal()
+
+
+def get_run_time(ordinal, bucket):
+    timezone, notification_time = bucket
+    moment = datetime.datetime.fromordinal(ordinal) + datetime.timedelta(minutes=notification_time - timezone * 60)
+    return moment.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+class NotificationScheduler:
+    def __init__(self, dispatcher, runs_path=RUNS_PATH, refresh_interval=REFRESH_INTERVAL, catch_up=CATCH_UP,
+                 clock=time.time):
+        self.dispatcher = dispatcher
+        self.runs_path = runs_path
+        self.refresh_interval = refresh_interval
+        self.catch_up = catch_up
+        self.clock = clock
+        self.heap = []
+        self.buckets = set()
+        self.refreshed = None
+        self.last_runs = self.load_runs()
+
+    def load_runs(self):
+        try:
+            with open(self.runs_path) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def save_runs(self):
+        path = self.runs_path + '.tmp'
+        with open(path, 'w') as file:
+            json.dump(self.last_runs, file)
+        os.replace(path, self.runs_path)
+
+    def get_next_run(self, bucket, now):
+        date = get_local_date(now, bucket[0])
+        last_run = self.last_runs.get(get_bucket_key(bucket))
+        if (last_run is not None and last_run >= date) or get_run_time(date, bucket) <= now - self.catch_up:
+            date += 1
+
+        return get_run_time(date, bucket), date
+
+    def schedule(self, bucket, now):
+        run_time, date = self.get_next_run(bucket, now)
+        heapq.heappush(self.heap, (run_time, date, bucket))
+
+    def refresh(self, now):
+        buckets = set(get_notification_buckets())
+        for bucket in buckets - self.buckets:
+            self.schedule(bucket, now)
+
+        self.buckets = buckets
+        self.refreshed = now
+
+    def dispatch(self, bucket, date):
+        key = get_bucket_key(bucket)
+        run_id = '{} {}'.format(datetime.date.fromordinal(date).isoformat(), key)
+        stats = self.dispatcher.dispatch(run_id, get_notifications(bucket, date), key)
+
+        self.last_runs[key] = date
+        self.save_runs()
+
+        return stats
+
+    def run_pending(self):
+        now = self.clock()
+        if self.refreshed is None or now - self.refreshed >= self.refresh_interval:
+            self.refresh(now)
+
+        while self.heap and self.heap[0][0] <= now:
+            run_time, date, bucket = heapq.heappop(self.heap)
+            if bucket not in self.buckets or self.last_runs.get(get_bucket_key(bucket), date - 1) >= date:
+                continue
+
+            try:
+                self.dispatch(bucket, date)
+            except Exception:
+                heapq.heappush(self.heap, (now + RETRY_DELAY, date, bucket))
+            else:
+                heapq.heappush(self.heap, (get_run_time(date + 1, bucket), date + 1, bucket))
+
@@ -0,0 +1,188 @@
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+
+from telebot import apihelper
+
+SHARDS = int(os.environ.get('SHARDS', os.cpu_count() or 2))
+QUEUE_SIZE = 256
+POLL_LIMIT = 100
+POLL_TIMEOUT = 20
+RETRY_DELAY = 1
+CHECK_INTERVAL = 1
+STATS_INTERVAL = 60
+
+logger = logging.getLogger('sharding')
+
+
+def get_update_key(update):
+    for kind in ('message', 'edited_message', 'callback_query'):
+        sender = update.get(kind, {}).get('from')
+        if sender:
+            return sender['id']
+
+    return update.get('update_id', 0)
+
+
+def run_worker(index, connection, run_timer):
+    from threading import Thread
+
+    from telebot.types import Update
+
+    import bot as sync_bot
+
+    sync_bot.bot.threaded = False
+    if run_timer:
+        Thread(target=sync_bot.timer, name='TimerThread', daemon=True).start()
+
+    while True:
+        try:
+            update = connection.recv()
+        except EOFError:
+            break
+
+        if update is None:
+            break
+
+        try:
+            sync_bot.bot.process_new_updates([Update.de_json(update)])
+        except Exception:
+            logger.exception('Shard %d failed to process update %s', index, update.get('update_id'))
+
+        connection.send(update['update_id'])
+
+    sync_bot.import_queue.shutdown()
+
+
+class Shard:
+    def __init__(self, index, context, size=QUEUE_SIZE):
+        self.index = index
+        self.context = context
+        self.updates = queue.Queue(maxsize=size)
+        self.processed = 0
+        self.restarts = 0
+        self.stopped = False
+        self.process = None
+        self.connection = None
+        self.start()
+        self.thread = threading.Thread(target=self.run, name='ShardFeeder-{}'.format(index), daemon=True)
+        self.thread.start()
+
+    def start(self):
+        connection, child_connection = self.context.Pipe()
+        self.process = self.context.Process(target=run_worker, args=(self.index, child_connection, self.index == 0),
+                                            name='Shard-{}'.format(self.index))
+        self.process.start()
+        child_connection.close()
+        self.connection = connection
+
+    def restart(self):
+        self.connection.close()
+        self.process.join()
+        logger.warning('Shard %d exited with code %s, restarting', self.index, self.process.exitcode)
+        self.restarts += 1
+        self.start()
+
+    def run(self):
+        while True:
+            try:
+                update = self.updates.get(timeout=CHECK_INTERVAL)
+            except queue.Empty:
+                if not self.process.is_alive() and not self.stopped:
+                    self.restart()
+                continue
+
+            try:
+                self.connection.send(update)
+                if update is None:
+                    self.process.join()
+                    return
+
+                self.connection.recv()
+                self.processed += 1
+
+            except (EOFError, OSError):
+                if self.stopped:
+                    return
+                if update is not None:
+                    logger.error('Shard %d lost update %s', self.index, update.get('update_id'))
+                self.restart()
+
+    def stats(self):
+        return {'shard': self.index, 'pid': self.process.pid, 'alive': self.process.is_alive(),
+                'processed': self.processed, 'restarts': self.restarts, 'queued': self.updates.qsize()}
+
+
+class Shards:
+    def __init__(self, workers=SHARDS, size=QUEUE_SIZE):
+        context = multiprocessing.get_context('spawn')
+        self.shards = [Shard(index, context, size) for index in range(workers)]
+        self.stopped = False
+
+    def put(self, update):
+        self.shards[get_update_key(update) % len(self.shards)].updates.put(update)
+
+    def stats(self):
+        return [shard.stats() for shard in self.shards]
+
+    def stop(self, timeout=None):
+        self.stopped = True
+        for shard in self.shards:
+            shard.stopped = True
+            shard.updates.put(None)
+        for shard in self.shards:
+            shard.thread.join(timeout)
+        for shard in self.shards:
+            if shard.process.is_alive():
+                shard.process.terminate()
+            shard.process.join()
+
+
+def report(shards, interval=STATS_INTERVAL):
+    while not shards.stopped:
+        time.sleep(interval)
+        for stats in shards.stats():
+            logger.info('Shard %(shard)d (pid %(pid)s): processed %(processed)d, restarts %(restarts)d, '
+                        'queued %(queued)d', stats)
+
+
+def poll(token, shards):
+    offset = None
+    while not shards.stopped:
+        try:
+            updates = apihelper.get_updates(token, offset=offset, limit=POLL_LIMIT, timeout=POLL_TIMEOUT,
+                                            long_polling_timeout=POLL_TIMEOUT)
+        except Exception:
+            logger.exception('Polling failed')
+            time.sleep(RETRY_DELAY)
+            continue
+
+        for update in updates:
+            shards.put(update)
+            offset = update['update_id'] + 1
+
+
+def main():
+    from my_token import TOKEN
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(processName)s %(name)s: %(message)s')
+    if os.environ.get('BOT_API_URL'):
+        apihelper.API_URL = os.environ['BOT_API_URL'].rstrip('/') + '/bot{0}/{1}'
+
+    import db  # run migrations once here, so the workers do not race on a fresh or outdated database
+
+    shards = Shards()
+    threading.Thread(target=report, args=(shards,), name='ReportThread', daemon=True).start()
+    try:
+        poll(TOKEN, shards)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        shards.stop(timeout=10)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+import json
+import os
+import time
+
+from cache import LRUCache
+from db import Conversation, Session, write
+
+ADD_SUBJECT = 'add_subject'
+ADD_DATE = 'add_date'
+ADD_TYPE = 'add_type'
+ADD_DESCRIPTION = 'add_description'
+DELETE_DATE = 'delete_date'
+CONFIRM_SCHEDULE = 'confirm_schedule'
+
+TRANSITIONS = {
+    ADD_SUBJECT: {ADD_DATE},
+    ADD_DATE: {ADD_TYPE, ADD_DESCRIPTION},
+    ADD_TYPE: {ADD_DESCRIPTION},
+    ADD_DESCRIPTION: set(),
+    DELETE_DATE: set(),
+    CONFIRM_SCHEDULE: set(),
+}
+
+CONVERSATION_TTL = 30 * 60
+MAX_CONVERSATIONS = 10000
+CONVERSATION_STORE = os.environ.get('CONVERSATION_STORE', 'memory')
+
+
+class InvalidTransitionError(Exception):
+    def __init__(self, current, new):
+        self.current = current
+        self.new = new
+
+    def __str__(self):
+        return 'Conversation cannot go from "{}" to "{}"'.format(self.current, self.new)
+
+
+class StateStore:
+    def load(self, user_id):
+        raise NotImplementedError
+
+    def save(self, user_id, state, data):
+        raise NotImplementedError
+
+    def finish(self, user_id):
+        raise NotImplementedError
+
+    def evict(self):
+        raise NotImplementedError
+
+    def get(self, user_id):
+        conversation = self.load(user_id)
+        return conversation[0] if conversation else None
+
+    def get_data(self, user_id):
+        conversation = self.load(user_id)
+        return conversation[1] if conversation else None
+
+    def start(self, user_id, state, **data):
+        if state not in TRANSITIONS:
+            raise InvalidTransitionError(None, state)
+
+        self.save(user_id, state, data)
+
+    def advance(self, user_id, state, **data):
+        conversation = self.load(user_id)
+        current = conversation[0] if conversation else None
+        if current is None or state not in TRANSITIONS[current]:
+            raise InvalidTransitionError(current, state)
+
+        self.save(user_id, state, dict(conversation[1], **data))
+
+
+class MemoryStateStore(StateStore):
+    def __init__(self, ttl=CONVERSATION_TTL, maxsize=MAX_CONVERSATIONS):
+        self.conversations = LRUCache(maxsize=maxsize, ttl=ttl)
+
+    def load(self, user_id):
+        return self.conversations.get(user_id)
+
+    def save(self, user_id, state, data):
+        self.conversations.set(user_id, (state, data))
+
+    def finish(self, user_id):
+        self.conversations.invalidate(user_id)
+
+    def evict(self):
+        self.conversations.evict()
+
+
+class SQLiteStateStore(StateStore):
+    def __init__(self, ttl=CONVERSATION_TTL, maxsize=MAX_CONVERSATIONS):
+        self.ttl = ttl
+        self.maxsize = maxsize
+
+    def load(self, user_id):
+        session = Session()
+        conversation = session.query(Conversation).filter(Conversation.telegram_id == user_id,
+                                                          Conversation.updated > time.time() - self.ttl).first()
+        result = (conversation.state, json.loads(conversation.data)) if conversation else None
+        session.close()
+
+        return result
+
+    def save(self, user_id, state, data):
+        conversation = Conversation(telegram_id=user_id, state=state, data=json.dumps(data), updated=time.time())
+        write(lambda session: session.merge(conversation))
+
+    def finish(self, user_id):
+        write(lambda session: session.query(Conversation).filter_by(telegram_id=user_id).delete())
+
+    def evict(self):
+        def delete_stale(session):
+            session.query(Conversation).filter(Conversation.updated <= time.time() - self.ttl).delete()
+            cutoff = session.query(Conversation.updated).order_by(Conversation.updated.desc()) \
+                .offset(self.maxsize).limit(1).scalar()
+            if cutoff is not None:
+                session.query(Conversation).filter(Conversation.updated <= cutoff).delete()
+
+        write(delete_stale)
+
+
+def create_store(kind=CONVERSATION_STORE):
+    if kind == 'sqlite':
+        return SQLiteStateStore()
+
+    return MemoryStateStore()
@@ -0,0 +1,104 @@
+import datetime
+import json
+
+import pytest
+from sqlalchemy import create_engine, event, text
+
+import planning
+from db import engine
+from migrations import MIGRATIONS, get_version, migrate
+from timetable import Timetable
+
+BASELINE_SCHEMA = (
+    'CREATE TABLE user (id INTEGER NOT NULL, telegram_id INTEGER, schedule JSON, PRIMARY KEY (id), '
+    'UNIQUE (telegram_id))',
+    'CREATE TABLE subject (id INTEGER NOT NULL, name VARCHAR NOT NULL, teacher VARCHAR, room VARCHAR, '
+    'user_id INTEGER, PRIMARY KEY (id), FOREIGN KEY(user_id) REFERENCES user (id))',
+    'CREATE TABLE settings (id INTEGER NOT NULL, language VARCHAR NOT NULL, timezone FLOAT NOT NULL, '
+    'user_id INTEGER, PRIMARY KEY (id), FOREIGN KEY(user_id) REFERENCES user (id))',
+    'CREATE TABLE homework (id INTEGER NOT NULL, date INTEGER NOT NULL, subject INTEGER NOT NULL, '
+    'for_lesson BOOLEAN NOT NULL, description VARCHAR NOT NULL, user_id INTEGER, PRIMARY KEY (id), '
+    'FOREIGN KEY(user_id) REFERENCES user (id))',
+)
+SUBJECTS = [('Subject {}'.format(index), None, None) for index in range(3)]
+SCHEDULE = [[[index % 3 for index in range(4)] + [-1] * 6 for week_day in range(6)] for week in range(2)]
+USER_ID = 3000
+
+
+@pytest.fixture(scope='module')
+def upgraded(tmp_path_factory):
+    baseline = create_engine('sqlite:///' + str(tmp_path_factory.mktemp('baseline') / 'db.sqlite3'))
+    with baseline.begin() as connection:
+        for statement in BASELINE_SCHEMA:
+            connection.execute(text(statement))
+        connection.execute(text("INSERT INTO user (id, telegram_id, schedule) VALUES (1, 1, '[]')"))
+        connection.execute(text('INSERT INTO user (id, telegram_id, schedule) VALUES (2, 2, :schedule)'),
+                           {'schedule': json.dumps(json.dumps(SCHEDULE))})
+        connection.execute(text("INSERT INTO subject (id, name, user_id) VALUES (1, 'Old subject', 1)"))
+        connection.execute(text("INSERT INTO settings (id, language, timezone, user_id) VALUES (1, 'en', 3, 1)"))
+        connection.execute(text("INSERT INTO homework (date, subject, for_lesson, description, user_id) "
+                                "VALUES (1, 0, 0, 'Old homework', 1)"))
+
+    migrate(baseline)
+    yield baseline
+    baseline.dispose()
+
+
+@pytest.fixture(scope='module')
+def today():
+    planning.store_schedule(USER_ID, SUBJECTS, SCHEDULE)
+    today = datetime.datetime.now(planning.TIMEZONE).date().toordinal()
+    planning.add_homework(USER_ID, 0, today + 1, False, 'Homework')
+    return today
+
+
+def capture(function, *args):
+    statements = []
+
+    def record(connection, cursor, statement, parameters, context, executemany):
+        if 'homework' in statement.lower() and 'homework_search' not in statement.lower():
+            statements.append((statement, parameters))
+
+    planning.schedule_cache.clear()
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        result = function(*args)
+        if hasattr(result, '__next__'):
+            list(result)
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+
+    assert statements
+    return statements
+
+
+def get_plans(upgraded, statements):
+    with upgraded.connect() as connection:
+        return [' '.join(row[-1] for row in connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters))
+                for statement, parameters in statements]
+
+
+def test_baseline_database_is_upgraded(upgraded):
+    with upgraded.connect() as connection:
+        assert get_version(connection) == len(MIGRATIONS)
+        indexes = {row[0] for row in connection.execute(text("SELECT name FROM sqlite_master WHERE type = 'index'"))}
+        assert {'ix_homework_user_date', 'ix_homework_date', 'ix_subject_user', 'ix_settings_notification'} <= indexes
+        assert connection.execute(text('SELECT notification_time FROM settings')).scalar() == 18 * 60
+        assert connection.execute(text("SELECT count(*) FROM homework_search WHERE homework_search MATCH 'old'")) \
+            .scalar() == 1
+        timetables = dict(connection.execute(text('SELECT id, timetable FROM user')).fetchall())
+        assert timetables[1] is None
+        assert Timetable.from_bytes(timetables[2]) == Timetable.from_schedule(SCHEDULE)
+        assert connection.execute(text('SELECT count(*) FROM user WHERE schedule IS NOT NULL')).scalar() == 0
+
+
+@pytest.mark.parametrize('query, index', [
+    (lambda today: planning.get_schedule(USER_ID, today + 1), 'ix_homework_user_date'),
+    (lambda today: planning.get_schedule_range(USER_ID, today, today + 6), 'ix_homework_user_date'),
+    (lambda today: planning.get_dates(USER_ID, ordinal=True), 'ix_homework_user_date'),
+    (lambda today: planning.delete_past_homework(), 'ix_homework_date'),
+    (lambda today: planning.get_notifications(today=today), 'ix_homework_date'),
+], ids=['per-day', 'range', 'distinct-dates', 'range-delete', 'digest'])
+def test_hot_queries_use_indexes(upgraded, today, query, index):
+    plans = get_plans(upgraded, capture(query, today))
+    assert any(index in plan for plan in plans), plans
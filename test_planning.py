@@ -0,0 +1,68 @@
+import datetime
+
+import pytest
+from sqlalchemy import event
+
+import planning
+from db import MAX_LESSONS, engine, get_snapshot
+
+SUBJECTS = [('Subject {}'.format(index), 'Teacher {}'.format(index), 'Room {}'.format(index)) for index in range(4)]
+
+
+class StatementCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, *args):
+        self.count += 1
+
+    def __enter__(self):
+        event.listen(engine, 'before_cursor_execute', self)
+        return self
+
+    def __exit__(self, *args):
+        event.remove(engine, 'before_cursor_execute', self)
+
+
+def next_monday():
+    today = datetime.datetime.now(planning.TIMEZONE).date()
+    return (today + datetime.timedelta(days=7 - today.weekday())).toordinal()
+
+
+def make_schedule(filled):
+    return [[[lesson % len(SUBJECTS) if lesson < filled else -1 for lesson in range(MAX_LESSONS)]
+             for week_day in range(6)] for week in range(2)]
+
+
+def count_day_statements(user_id, ordinal_date):
+    get_snapshot(user_id)
+    planning.schedule_cache.clear()
+    with StatementCounter() as counter:
+        planning.get_schedule(user_id, ordinal_date)
+
+    return counter.count
+
+
+@pytest.mark.parametrize('filled', [0, MAX_LESSONS])
+def test_day_costs_one_statement(filled):
+    user_id = 1000 + filled
+    date = next_monday()
+    planning.store_schedule(user_id, SUBJECTS, make_schedule(filled))
+    for subject_index in range(len(SUBJECTS)):
+        planning.add_homework(user_id, subject_index, date, True, 'Lesson homework {}'.format(subject_index))
+        planning.add_homework(user_id, subject_index, date, False, 'Day homework {}'.format(subject_index))
+
+    assert count_day_statements(user_id, date) == 1
+
+
+def test_day_statements_do_not_grow_with_homework():
+    user_id = 2000
+    date = next_monday()
+    planning.store_schedule(user_id, SUBJECTS, make_schedule(MAX_LESSONS))
+    before = count_day_statements(user_id, date)
+
+    for index in range(20):
+        planning.add_homework(user_id, index % len(SUBJECTS), date, index % 2 == 0, 'Homework {}'.format(index))
+
+    assert count_day_statements(user_id, date) == before
+    assert 'Homework 19' in planning.get_schedule(user_id, date)
@@ -0,0 +1,34 @@
+import datetime
+
+from timetable import WEEKS, WEEK_DAYS, Timetable
+
+LESSONS = 4
+
+
+def make_timetable(*positions):
+    schedule = [[[-1] * LESSONS for week_day in range(WEEK_DAYS)] for week in range(WEEKS)]
+    for subject, week, week_day in positions:
+        schedule[week][week_day][0] = subject
+    return Timetable.from_schedule(schedule)
+
+
+def ordinal(year, month, day):
+    return datetime.date(year, month, day).toordinal()
+
+
+def test_next_lesson_crosses_a_53_week_year():
+    timetable = make_timetable((0, 1, 0))
+
+    assert timetable.next_lesson(0, ordinal(2026, 12, 29)) == ordinal(2027, 1, 4)
+    assert timetable.has_lesson(ordinal(2027, 1, 4), 0)
+    assert timetable.next_lessons(0, ordinal(2026, 12, 20), 3) == \
+        [ordinal(2026, 12, 28), ordinal(2027, 1, 4), ordinal(2027, 1, 18)]
+
+
+def test_next_lesson_matches_has_lesson():
+    timetable = make_timetable((0, 1, 0), (0, 1, 1), (1, 0, 1), (2, 0, 5), (2, 1, 3))
+
+    for start in range(ordinal(2026, 11, 1), ordinal(2027, 3, 1)):
+        for subject in range(3):
+            expected = next(date for date in range(start, start + 28) if timetable.has_lesson(date, subject))
+            assert timetable.next_lesson(subject, start) == expected, (subject, datetime.date.fromordinal(start))
@@ -0,0 +1,121 @@
+import datetime
+import struct
+import sys
+from array import array
+
+MAX_LESSONS = 10
+WEEKS = 2
+WEEK_DAYS = 6
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<BB')
+
+
+def get_position(ordinal_date):
+    date = datetime.date.fromordinal(ordinal_date)
+    return date.isocalendar()[1] % 2, date.weekday()
+
+
+class Timetable:
+    __slots__ = ('lessons', 'slots', 'index', 'days', 'next_offsets')
+
+    def __init__(self, slots, lessons):
+        if len(slots) != WEEKS * WEEK_DAYS * lessons:
+            raise ValueError('Timetable must have {} slots, got {}'.format(WEEKS * WEEK_DAYS * lessons, len(slots)))
+
+        self.lessons = lessons
+        self.slots = slots
+
+        index = {}
+        for position, subject in enumerate(slots):
+            if subject != -1:
+                week, rest = divmod(position, WEEK_DAYS * lessons)
+                week_day, slot = divmod(rest, lessons)
+                index.setdefault(subject, []).append((week, week_day, slot))
+
+        self.index = {subject: tuple(positions) for subject, positions in index.items()}
+        self.days = {subject: frozenset(week * 7 + week_day for week, week_day, slot in positions)
+                     for subject, positions in self.index.items()}
+
+        self.next_offsets = {}
+        for subject, days in self.days.items():
+            offsets = array('b', [-1] * WEEKS * 7)
+            for start in range(WEEKS * 7):
+                for offset in range(WEEKS * 7):
+                    if (start + offset) % (WEEKS * 7) in days:
+                        offsets[start] = offset
+                        break
+            self.next_offsets[subject] = offsets
+
+    def __eq__(self, other):
+        return isinstance(other, Timetable) and self.lessons == other.lessons and self.slots == other.slots
+
+    def __repr__(self):
+        return 'Timetable with {} subjects'.format(len(self.index))
+
+    @classmethod
+    def from_schedule(cls, schedule):
+        lessons = len(schedule[0][0])
+        slots = array('h', (subject for week in schedule for day in week for subject in day))
+        return cls(slots, lessons)
+
+    @classmethod
+    def from_bytes(cls, data):
+        version, lessons = HEADER.unpack_from(data)
+        if version != FORMAT_VERSION:
+            raise ValueError('Unsupported timetable format version {}'.format(version))
+
+        slots = array('h')
+        slots.frombytes(data[HEADER.size:])
+        if sys.byteorder != 'little':
+            slots.byteswap()
+
+        return cls(slots, lessons)
+
+    def to_bytes(self):
+        slots = array('h', self.slots)
+        if sys.byteorder != 'little':
+            slots.byteswap()
+
+        return HEADER.pack(FORMAT_VERSION, self.lessons) + slots.tobytes()
+
+    def day(self, week, week_day):
+        if week_day >= WEEK_DAYS:
+            return ()
+
+        start = (week * WEEK_DAYS + week_day) * self.lessons
+        return tuple(self.slots[start:start + self.lessons])
+
+    def lessons_on(self, ordinal_date):
+        return self.day(*get_position(ordinal_date))
+
+    def next_lesson(self, subject, ordinal_date):
+        offsets = self.next_offsets.get(subject)
+        if offsets is None:
+            return None
+
+        week, week_day = get_position(ordinal_date)
+        offset = offsets[week * 7 + week_day]
+        while week_day + offset >= 7:
+            # the table assumes alternating weeks, which breaks after ISO week 53, so re-check every new week
+            ordinal_date += 7 - week_day
+            week, week_day = get_position(ordinal_date)
+            offset = offsets[week * 7]
+
+        return ordinal_date + offset
+
+    def next_lessons(self, subject, ordinal_date, count):
+        dates = []
+        date = self.next_lesson(subject, ordinal_date)
+        while date is not None and len(dates) < count:
+            dates.append(date)
+            date = self.next_lesson(subject, date + 1)
+
+        return dates
+
+    def has_lesson(self, ordinal_date, subject):
+        days = self.days.get(subject)
+        if days is None:
+            return False
+
+        week, week_day = get_position(ordinal_date)
+        return week * 7 + week_day in days
@@ -0,0 +1,243 @@
+import csv
+import datetime
+import re
+from io import StringIO
+from tempfile import SpooledTemporaryFile
+
+from db import Homework, Session, get_snapshot, write
+from metrics import timed
+from planning import TIMEZONE, ScheduleNotFoundError, schedule_cache
+
+CSV_FIELDS = ('kind', 'date', 'lesson', 'subject', 'type', 'description', 'teacher', 'room')
+EXPORT_FORMATS = ('csv', 'ics')
+TIMETABLE_DAYS = 14
+CHUNK_SIZE = 500
+MAX_IMPORT_ROWS = 5000
+ICS_LINE_LENGTH = 75
+SPOOL_SIZE = 1024 * 1024
+
+
+class ImportFormatError(Exception):
+    def __init__(self, line, reason):
+        self.line = line
+        self.reason = reason
+
+    def __str__(self):
+        return 'Line {}: {}'.format(self.line, self.reason)
+
+
+def parse_iso_date(text):
+    return datetime.date.fromisoformat(text.strip()).toordinal()
+
+
+def parse_ics_date(text):
+    return datetime.datetime.strptime(text.strip()[:8], '%Y%m%d').date().toordinal()
+
+
+def escape_ics(text):
+    return text.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
+
+
+def unescape_ics(text):
+    return re.sub(r'\\([\\;,nN])', lambda match: '\n' if match.group(1) in 'nN' else match.group(1), text)
+
+
+def fold_ics(line):
+    parts = []
+    current = ''
+    size = 0
+    for char in line:
+        length = len(char.encode())
+        if size + length > ICS_LINE_LENGTH:
+            parts.append(current)
+            current = ' '
+            size = 1
+        current += char
+        size += length
+
+    parts.append(current)
+    return '\r\n'.join(parts) + '\r\n'
+
+
+def unfold_ics(text):
+    return re.sub(r'\r?\n[ \t]', '', text).splitlines()
+
+
+def read_csv(text):
+    reader = csv.DictReader(StringIO(text))
+    missing = {'date', 'subject', 'description'} - set(reader.fieldnames or ())
+    if missing:
+        raise ImportFormatError(1, 'missing columns: {}'.format(', '.join(sorted(missing))))
+
+    for row in reader:
+        if (row.get('kind') or 'homework').strip().lower() == 'homework':
+            yield reader.line_num, row['date'] or '', row['subject'] or '', row.get('type') or 'day', \
+                row['description'] or '', parse_iso_date
+
+
+def read_ics(text):
+    event = None
+    for number, line in enumerate(unfold_ics(text), start=1):
+        name, _, value = line.partition(':')
+        name = name.partition(';')[0].upper()
+        if name == 'BEGIN' and value.upper() == 'VEVENT':
+            event = {'line': number}
+        elif name == 'END' and value.upper() == 'VEVENT' and event is not None:
+            if event.get('categories', 'homework').lower() == 'homework':
+                yield event['line'], event.get('dtstart', ''), event.get('summary', ''), \
+                    event.get('x-homework-type', 'day'), event.get('description', ''), parse_ics_date
+            event = None
+        elif event is not None and name in ('DTSTART', 'SUMMARY', 'DESCRIPTION', 'CATEGORIES', 'X-HOMEWORK-TYPE'):
+            event[name.lower()] = unescape_ics(value)
+
+
+def parse_homework(user, rows):
+    subjects = {subject.name.strip().lower(): index for index, subject in enumerate(user.subjects)}
+    today = datetime.datetime.now(TIMEZONE).date().toordinal()
+
+    result = []
+    for line, date, subject, kind, description, parse_date in rows:
+        if len(result) >= MAX_IMPORT_ROWS:
+            raise ImportFormatError(line, 'too many rows (at most {})'.format(MAX_IMPORT_ROWS))
+
+        try:
+            ordinal_date = parse_date(date)
+        except ValueError:
+            raise ImportFormatError(line, 'incorrect date "{}"'.format(date))
+
+        if ordinal_date < today:
+            raise ImportFormatError(line, 'past date "{}"'.format(date))
+
+        subject_index = subjects.get(subject.strip().lower())
+        if subject_index is None:
+            raise ImportFormatError(line, 'unknown subject "{}"'.format(subject))
+
+        kind = kind.strip().lower()
+        if kind not in ('lesson', 'day'):
+            raise ImportFormatError(line, 'type must be "lesson" or "day"')
+
+        description = description.strip()
+        if not description:
+            raise ImportFormatError(line, 'empty description')
+
+        for_lesson = kind == 'lesson' and user.schedule.has_lesson(ordinal_date, subject_index)
+        result.append({'date': ordinal_date, 'subject': subject_index, 'for_lesson': for_lesson,
+                       'description': description, 'user_id': user.id})
+
+    return result
+
+
+@timed
+def import_homework(user_id, file_name, content):
+    user = get_snapshot(user_id)
+    if not user.schedule or not user.subjects:
+        raise ScheduleNotFoundError
+
+    text = content.decode('utf-8-sig') if isinstance(content, (bytes, bytearray)) else content
+    if file_name.lower().endswith('.ics'):
+        rows = parse_homework(user, read_ics(text))
+    else:
+        rows = parse_homework(user, read_csv(text))
+
+    if rows:
+        write(lambda session: session.execute(Homework.__table__.insert(), rows))
+        schedule_cache.bump(user_id)
+
+    return len(rows)
+
+
+def iter_homework(user):
+    session = Session()
+    try:
+        query = session.query(Homework.date, Homework.subject, Homework.for_lesson, Homework.description) \
+            .filter(Homework.user_id == user.id).order_by(Homework.date, Homework.subject, Homework.id) \
+            .yield_per(CHUNK_SIZE)
+        for row in query:
+            yield row
+    finally:
+        session.close()
+
+
+def iter_lessons(user, start, days=TIMETABLE_DAYS):
+    for ordinal_date in range(start, start + days):
+        for index, subject_index in enumerate(user.schedule.lessons_on(ordinal_date)):
+            if subject_index != -1:
+                yield ordinal_date, index + 1, user.subjects[subject_index]
+
+
+def export_csv(user, start):
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(CSV_FIELDS)
+
+    for number, h in enumerate(iter_homework(user), start=1):
+        writer.writerow(('homework', datetime.date.fromordinal(h.date).isoformat(), '', user.subjects[h.subject].name,
+                         'lesson' if h.for_lesson else 'day', h.description, '', ''))
+        if number % CHUNK_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    for ordinal_date, lesson, subject in iter_lessons(user, start):
+        writer.writerow(('lesson', datetime.date.fromordinal(ordinal_date).isoformat(), lesson, subject.name, '', '',
+                         subject.teacher or '', subject.room or ''))
+
+    yield buffer.getvalue()
+
+
+def export_ics(user, start):
+    stamp = datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
+    yield 'BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//Homework Planning Bot//EN\r\n'
+
+    for number, h in enumerate(iter_homework(user), start=1):
+        date = datetime.date.fromordinal(h.date)
+        yield ''.join((
+            'BEGIN:VEVENT\r\n',
+            fold_ics('UID:homework-{}-{}@homework-planning-bot'.format(user.telegram_id, number)),
+            'DTSTAMP:{}\r\n'.format(stamp),
+            'DTSTART;VALUE=DATE:{:%Y%m%d}\r\n'.format(date),
+            fold_ics('SUMMARY:' + escape_ics(user.subjects[h.subject].name)),
+            fold_ics('DESCRIPTION:' + escape_ics(h.description)),
+            'CATEGORIES:HOMEWORK\r\n',
+            'X-HOMEWORK-TYPE:{}\r\n'.format('lesson' if h.for_lesson else 'day'),
+            'END:VEVENT\r\n',
+        ))
+
+    for ordinal_date, lesson, subject in iter_lessons(user, start):
+        date = datetime.date.fromordinal(ordinal_date)
+        lines = ['BEGIN:VEVENT\r\n',
+                 'UID:lesson-{}-{:%Y%m%d}-{}@homework-planning-bot\r\n'.format(user.telegram_id, date, lesson),
+                 'DTSTAMP:{}\r\n'.format(stamp),
+                 'DTSTART;VALUE=DATE:{:%Y%m%d}\r\n'.format(date),
+                 fold_ics('SUMMARY:' + escape_ics('{}. {}'.format(lesson, subject.name))),
+                 'CATEGORIES:TIMETABLE\r\n']
+        if subject.teacher is not None:
+            lines.append(fold_ics('DESCRIPTION:' + escape_ics(subject.teacher)))
+        if subject.room is not None:
+            lines.append(fold_ics('LOCATION:' + escape_ics(subject.room)))
+        lines.append('END:VEVENT\r\n')
+        yield ''.join(lines)
+
+    yield 'END:VCALENDAR\r\n'
+
+
+def export_homework(user_id, export_format='csv'):
+    user = get_snapshot(user_id)
+    if not user.schedule or not user.subjects:
+        raise ScheduleNotFoundError
+
+    start = datetime.datetime.now(TIMEZONE).date().toordinal()
+    if export_format == 'ics':
+        return export_ics(user, start)
+
+    return export_csv(user, start)
+
+
+@timed
+def spool_export(user_id, export_format='csv'):
+    file = SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    for chunk in export_homework(user_id, export_format):
+        file.write(chunk.encode())
+
+    file.seek(0)
+    return file
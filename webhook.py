@@ -0,0 +1,124 @@
+import hmac
+import json
+import logging
+import os
+import queue
+import secrets
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telebot.types import Update
+
+import bot as sync_bot
+from metrics import registry, start_server
+from sharding import get_update_key
+
+WEBHOOK_HOST = os.environ.get('WEBHOOK_HOST', '127.0.0.1')
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', 8443))
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', '/webhook')
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET', '')
+WORKERS = 4
+QUEUE_SIZE = 256
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+logger = logging.getLogger('webhook')
+
+
+class UpdateQueue:
+    def __init__(self, process, workers=WORKERS, size=QUEUE_SIZE):
+        self.process = process
+        self.queues = [queue.Queue(maxsize=max(1, size // workers)) for i in range(workers)]
+        self.threads = [threading.Thread(target=self.run, args=(q,), name='UpdateWorker-{}'.format(i), daemon=True)
+                        for i, q in enumerate(self.queues)]
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, update):
+        try:
+            self.queues[get_update_key(update) % len(self.queues)].put_nowait(update)
+        except queue.Full:
+            return False
+
+        return True
+
+    def depth(self):
+        return sum(q.qsize() for q in self.queues)
+
+    def run(self, updates):
+        while True:
+            update = updates.get()
+            try:
+                self.process(update)
+            except Exception:
+                logger.exception('Failed to process update %s', update.get('update_id'))
+            finally:
+                updates.task_done()
+
+    def join(self):
+        for q in self.queues:
+            q.join()
+
+
+def process_update(update):
+    sync_bot.bot.process_new_updates([Update.de_json(update)])
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    updates = None
+    secret = WEBHOOK_SECRET
+
+    def do_POST(self):
+        if self.path != WEBHOOK_PATH:
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        if self.secret and not hmac.compare_digest(self.headers.get(SECRET_HEADER, ''), self.secret):
+            self.send_response(403)
+            self.end_headers()
+            return
+
+        try:
+            update = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        except ValueError:
+            self.send_response(400)
+            self.end_headers()
+            return
+
+        self.send_response(200 if self.updates.put(update) else 503)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def create_server(updates, host=WEBHOOK_HOST, port=WEBHOOK_PORT, secret=WEBHOOK_SECRET):
+    handler = type('BoundWebhookHandler', (WebhookHandler,), {'updates': updates, 'secret': secret})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def main():
+    sync_bot.bot.threaded = False
+
+    updates = UpdateQueue(process_update)
+    registry.gauge('webhook_queue_depth', updates.depth, 'Updates waiting for a webhook worker.')
+    start_server()
+
+    secret = WEBHOOK_SECRET
+    if WEBHOOK_URL and not secret:
+        secret = secrets.token_urlsafe(32)
+
+    server = create_server(updates, secret=secret)
+    if WEBHOOK_URL:
+        sync_bot.bot.remove_webhook()
+        sync_bot.bot.set_webhook(url=WEBHOOK_URL, secret_token=secret)
+
+    timer_thread = threading.Thread(target=sync_bot.timer, name='TimerThread', daemon=True)
+    timer_thread.start()
+
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
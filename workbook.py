@@ -0,0 +1,72 @@
+import json
+import os
+import sys
+from io import BytesIO
+
+from openpyxl import load_workbook
+
+from timetable import MAX_LESSONS
+
+SCHEDULE_COLUMNS = (range(6, 12), range(14, 20))
+
+
+def is_empty(value):
+    return value is None or (isinstance(value, str) and not value.strip())
+
+
+def parse_schedule(file):
+    if isinstance(file, (bytes, bytearray)):
+        file = BytesIO(file)
+
+    workbook = load_workbook(file, read_only=True, data_only=True)
+    try:
+        sheet = workbook.worksheets[0]
+
+        subjects = []
+        schedule = [[[] for week_day in range(6)] for week in range(2)]
+        for row_index, row in enumerate(sheet.iter_rows(min_row=2, max_col=SCHEDULE_COLUMNS[1][-1] + 1,
+                                                        values_only=True)):
+            row += (None,) * (SCHEDULE_COLUMNS[1][-1] + 1 - len(row))
+
+            name, teacher, room = row[1:4]
+            if not is_empty(name):
+                subjects.append((str(name), None if is_empty(teacher) else str(teacher),
+                                 None if is_empty(room) else str(room)))
+
+            if 1 <= row_index <= MAX_LESSONS:
+                for week, columns in enumerate(SCHEDULE_COLUMNS):
+                    for week_day, column in enumerate(columns):
+                        value = row[column]
+                        schedule[week][week_day].append(-1 if is_empty(value) else int(value))
+
+    finally:
+        workbook.close()
+
+    for week in schedule:
+        for day in week:
+            day.extend([-1] * (MAX_LESSONS - len(day)))
+
+    return subjects, schedule
+
+
+def serve(requests, responses):
+    while True:
+        header = requests.readline()
+        if not header:
+            return
+
+        content = requests.read(int(header))
+        try:
+            subjects, schedule = parse_schedule(content)
+            response = {'subjects': subjects, 'schedule': schedule}
+        except Exception as e:
+            response = {'error': str(e)}
+
+        responses.write(json.dumps(response).encode() + b'\n')
+        responses.flush()
+
+
+if __name__ == '__main__':
+    responses = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    serve(sys.stdin.buffer, responses)
@@ -0,0 +1,63 @@
+import contextvars
+import threading
+from concurrent.futures import Future
+from queue import Empty, Queue
+
+BATCH_SIZE = 64
+
+
+class Writer:
+    def __init__(self, session_factory, batch_size=BATCH_SIZE):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.queue = Queue()
+        self.thread = threading.Thread(target=self.run, name='WriterThread', daemon=True)
+        self.thread.start()
+
+    def submit(self, job):
+        future = Future()
+        self.queue.put((job, future, contextvars.copy_context()))
+        return future
+
+    def write(self, job):
+        return self.submit(job).result()
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Empty:
+                    break
+
+            batch = [item for item in batch if item[1].set_running_or_notify_cancel()]
+            if batch:
+                self.commit(batch)
+
+    @staticmethod
+    def run_job(job, session):
+        result = job(session)
+        session.flush()
+        return result
+
+    def commit(self, batch):
+        session = self.session_factory()
+        try:
+            results = [context.run(self.run_job, job, session) for job, future, context in batch]
+            session.commit()
+
+        except Exception as e:
+            session.rollback()
+            if len(batch) == 1:
+                batch[0][1].set_exception(e)
+            else:
+                for item in batch:
+                    self.commit([item])
+
+        else:
+            for (job, future, context), result in zip(batch, results):
+                future.set_result(result)
+
+        finally:
+            session.close()